@@ -4,6 +4,8 @@ import requests
 import json
 from dotenv import load_dotenv
 from datetime import datetime
+from llm_scheduler import scheduler, SchedulerFull, INTERACTIVE, BULK
+from profiling import phase
 
 # Load environment variables
 load_dotenv()
@@ -26,10 +28,21 @@ class AITutorService:
         if self.use_fallback:
             print("WARNING: No OpenAI API key found. Using fallback responses.")
     
-    def generate_learning_path(self, subject_name: str, level: str) -> Dict[str, Any]:
-        """Generate a customized learning path based on subject and proficiency level"""
+    def generate_learning_path(
+        self,
+        subject_name: str,
+        level: str,
+        user_id: Optional[str] = None,
+        priority: str = BULK,
+        allow_fallback: bool = True
+    ) -> Optional[Dict[str, Any]]:
+        """Generate a customized learning path based on subject and proficiency level.
+
+        With allow_fallback=False, returns None instead of the generic fallback path
+        when the AI service is unavailable or its response cannot be used.
+        """
         if self.use_fallback:
-            return self._create_fallback_learning_path(subject_name, level)
+            return self._create_fallback_learning_path(subject_name, level) if allow_fallback else None
             
         prompt = f"""
         Create a detailed, structured learning path for {subject_name} at {level} level.
@@ -72,10 +85,11 @@ class AITutorService:
         }}
         """
         
-        response = self._call_ai_api(prompt, max_tokens=1500)
+        response = self._call_ai_api(prompt, max_tokens=1500, priority=priority, user_id=user_id)
         print("response: ", response)
         try:
-            learning_path = json.loads(response)
+            with phase("json"):
+                learning_path = json.loads(response)
             print("learning_path: ", learning_path)
             # Validate the structure
             if not all(key in learning_path for key in ["subject", "level", "modules"]):
@@ -83,7 +97,7 @@ class AITutorService:
             return learning_path
         except (json.JSONDecodeError, ValueError) as e:
             print(f"Error parsing AI response: {str(e)}")
-            return self._create_fallback_learning_path(subject_name, level)
+            return self._create_fallback_learning_path(subject_name, level) if allow_fallback else None
     
     def get_chat_response(
         self,
@@ -91,7 +105,8 @@ class AITutorService:
         user_message: str,
         chat_history: List[Dict] = None,
         tutor_style: str = "default",
-        user_level: str = "beginner"
+        user_level: str = "beginner",
+        user_id: Optional[str] = None
     ) -> str:
         """Get a contextual response from the AI tutor"""
         if self.use_fallback:
@@ -132,7 +147,9 @@ class AITutorService:
         response = self._call_ai_api(
             messages=context_messages,
             temperature=0.7 if tutor_style == "friendly" else 0.5,
-            max_tokens=500
+            max_tokens=500,
+            priority=INTERACTIVE,
+            user_id=user_id
         )
         
         return response
@@ -143,7 +160,8 @@ class AITutorService:
         topic: str,
         level: str,
         question_type: str = "multiple_choice",
-        count: int = 5
+        count: int = 5,
+        user_id: Optional[str] = None
     ) -> List[Dict[str, Any]]:
         """Generate practice questions on a specific topic"""
         if self.use_fallback:
@@ -171,10 +189,11 @@ class AITutorService:
         ]
         """
         
-        response = self._call_ai_api(prompt, max_tokens=1200)
+        response = self._call_ai_api(prompt, max_tokens=1200, priority=BULK, user_id=user_id)
         
         try:
-            questions = json.loads(response)
+            with phase("json"):
+                questions = json.loads(response)
             if not isinstance(questions, list):
                 raise ValueError("Expected array of questions")
             return questions
@@ -187,9 +206,14 @@ class AITutorService:
         prompt: Optional[str] = None,
         messages: Optional[List[Dict]] = None,
         temperature: float = 0.7,
-        max_tokens: int = 800
+        max_tokens: int = 800,
+        priority: str = BULK,
+        user_id: Optional[str] = None
     ) -> str:
-        """Make a call to the OpenAI API with either prompt or messages"""
+        """Make a call to the OpenAI API with either prompt or messages.
+
+        The call waits in the shared LLM scheduler for a slot of its priority class.
+        """
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
@@ -209,14 +233,20 @@ class AITutorService:
         }
         
         try:
-            response = requests.post(
-                self.api_url,
+            response = scheduler.run(
+                priority,
+                user_id,
+                self._post,
                 headers=headers,
                 json=data,
                 timeout=15
             )
             response.raise_for_status()
-            return response.json()["choices"][0]["message"]["content"]
+            with phase("json"):
+                return response.json()["choices"][0]["message"]["content"]
+        except SchedulerFull:
+            # Let the caller report overload instead of storing an error message as content
+            raise
         except requests.exceptions.RequestException as e:
             print(f"API Error: {str(e)}")
             return f"I'm having trouble accessing my knowledge base. Please try again later."
@@ -224,6 +254,11 @@ class AITutorService:
             print(f"Unexpected error: {str(e)}")
             return "An unexpected error occurred. Please try your request again."
     
+    def _post(self, **kwargs) -> requests.Response:
+        """POST to the OpenAI API, timed as the "ai" phase when profiling"""
+        with phase("ai"):
+            return requests.post(self.api_url, **kwargs)
+    
     def _create_fallback_learning_path(self, subject_name: str, level: str) -> Dict[str, Any]:
         """Create a structured fallback learning path"""
         modules = []
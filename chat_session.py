@@ -0,0 +1,230 @@
+import asyncio
+import json
+import os
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+from starlette.websockets import WebSocketState
+import models, schemas
+from ai_service import AITutorService
+from database import SessionLocal
+
+CONTEXT_WINDOW = 10
+# Past this many missed messages a resume fails and the client reloads instead
+RESUME_LIMIT = 200
+# Messages a client may queue while the tutor is still answering
+MAX_PENDING = int(os.getenv("WS_MAX_PENDING_MESSAGES", 5))
+HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_SECONDS", 20))
+# Close connections that have sent nothing, not even a pong, for this long
+HEARTBEAT_TIMEOUT = float(os.getenv("WS_HEARTBEAT_TIMEOUT_SECONDS", 60))
+
+
+def _serialize(message: models.ChatMessage) -> Dict[str, Any]:
+    return jsonable_encoder(schemas.ChatMessage.from_orm(message))
+
+
+class ChatSession:
+    """Conversation state held in memory for one WebSocket connection.
+
+    The subject and the recent-context window are loaded once when the
+    connection opens, so a turn only writes the two messages and calls the AI.
+    """
+
+    def __init__(self, subject_id: str, subject_name: str, user_id: Optional[str], history: List[Dict[str, str]]):
+        self.subject_id = subject_id
+        self.subject_name = subject_name
+        self.user_id = user_id
+        self.window = deque(history, maxlen=CONTEXT_WINDOW)
+
+    def _save(self, sender: str, content: str) -> Dict[str, Any]:
+        db = SessionLocal()
+        try:
+            message = models.ChatMessage(
+                id=str(uuid.uuid4()),
+                subject_id=self.subject_id,
+                sender=sender,
+                content=content,
+                timestamp=datetime.now()
+            )
+            db.add(message)
+            db.commit()
+            db.refresh(message)
+            return _serialize(message)
+        finally:
+            db.close()
+
+    def add_user_message(self, content: str) -> Dict[str, Any]:
+        return self._save("user", content)
+
+    def reply(self, content: str, ai_service: AITutorService) -> Dict[str, Any]:
+        """Get the tutor's answer to a user message and save it"""
+        ai_response = ai_service.get_chat_response(
+            subject_name=self.subject_name,
+            user_message=content,
+            chat_history=list(self.window),
+            user_id=self.user_id
+        )
+        self.window.append({"sender": "user", "content": content})
+        self.window.append({"sender": "tutor", "content": ai_response})
+        return self._save("tutor", ai_response)
+
+
+def _resume_failed(last_message_id: str, detail: str) -> Dict[str, Any]:
+    return {"type": "resume_failed", "last_message_id": last_message_id, "detail": detail}
+
+
+def open_session(
+    subject_id: str,
+    user_id: Optional[str],
+    last_message_id: Optional[str]
+) -> Tuple[Optional[ChatSession], Optional[Dict[str, Any]]]:
+    """Load the subject and context window, and answer a resume from last_message_id.
+
+    Returns (None, None) if the subject does not exist. The second item is the
+    frame to send first: "history" with the messages missed since
+    last_message_id, "resume_failed" if that message is unknown or more than
+    RESUME_LIMIT were missed, or None when no resume was requested.
+    """
+    db = SessionLocal()
+    try:
+        db_subject = db.query(models.Subject).filter(models.Subject.id == subject_id).first()
+        if db_subject is None:
+            return None, None
+        recent = db.query(models.ChatMessage).filter(
+            models.ChatMessage.subject_id == subject_id
+        ).order_by(models.ChatMessage.timestamp.desc()).limit(CONTEXT_WINDOW).all()
+        history = [{"sender": msg.sender, "content": msg.content} for msg in reversed(recent)]
+        session = ChatSession(subject_id, db_subject.name, user_id, history)
+
+        if not last_message_id:
+            return session, None
+        anchor = db.query(models.ChatMessage).filter(
+            models.ChatMessage.id == last_message_id,
+            models.ChatMessage.subject_id == subject_id
+        ).first()
+        if anchor is None:
+            # The client cannot tell what it missed; it should reload the history
+            return session, _resume_failed(last_message_id, "Unknown last_message_id; reload the conversation")
+        missed = db.query(models.ChatMessage).filter(
+            models.ChatMessage.subject_id == subject_id,
+            models.ChatMessage.timestamp > anchor.timestamp
+        ).order_by(models.ChatMessage.timestamp.asc()).limit(RESUME_LIMIT + 1).all()
+        if len(missed) > RESUME_LIMIT:
+            # A cut-off history would look complete to the client
+            return session, _resume_failed(last_message_id, "Too many missed messages; reload the conversation")
+        return session, {"type": "history", "messages": [_serialize(msg) for msg in missed]}
+    finally:
+        db.close()
+
+
+async def serve(websocket: WebSocket, session: ChatSession, resume: Optional[Dict[str, Any]], ai_service: AITutorService):
+    """Run the chat protocol on an accepted WebSocket until it closes.
+
+    Client frames: {"type": "message", "content": ..., "client_id": ...}, {"type": "ping"}
+    and {"type": "pong"}. Server frames: "message" (the saved user message, then
+    the tutor's answer), "history" (messages missed before a resume),
+    "resume_failed" (the last seen message is unknown or too far back), "ping",
+    "pong" and "error" (for a bad frame or a failed turn, with its client_id).
+    """
+    loop = asyncio.get_running_loop()
+    inbox: asyncio.Queue = asyncio.Queue(maxsize=MAX_PENDING)
+    send_lock = asyncio.Lock()
+    last_seen = loop.time()
+
+    async def send(frame: Dict[str, Any]):
+        async with send_lock:
+            await websocket.send_json(frame)
+
+    async def reader():
+        nonlocal last_seen
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+            last_seen = loop.time()
+            raw = message.get("text")
+            if raw is None:
+                await send({"type": "error", "detail": "Frames must be text"})
+                continue
+            try:
+                frame = json.loads(raw)
+            except json.JSONDecodeError:
+                await send({"type": "error", "detail": "Frames must be JSON"})
+                continue
+            if not isinstance(frame, dict):
+                await send({"type": "error", "detail": "Frames must be JSON objects"})
+                continue
+            kind = frame.get("type")
+            if kind == "ping":
+                await send({"type": "pong"})
+            elif kind == "pong":
+                continue
+            elif kind == "message":
+                content = str(frame.get("content") or "").strip()
+                if not content:
+                    await send({"type": "error", "detail": "Message content is required", "client_id": frame.get("client_id")})
+                    continue
+                try:
+                    inbox.put_nowait((content, frame.get("client_id")))
+                except asyncio.QueueFull:
+                    # Backpressure: reject rather than buffer without bound
+                    await send({"type": "error", "detail": "Too many pending messages", "client_id": frame.get("client_id")})
+            else:
+                await send({"type": "error", "detail": f"Unknown frame type: {kind}"})
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            if loop.time() - last_seen > HEARTBEAT_TIMEOUT:
+                await websocket.close(code=1001, reason="Heartbeat timeout")
+                return
+            await send({"type": "ping"})
+
+    async def turn(step, *args) -> Optional[Dict[str, Any]]:
+        # A failed turn is reported to the client; the connection stays open
+        try:
+            return await run_in_threadpool(step, *args)
+        except Exception as e:
+            print(f"WebSocket chat turn failed: {str(e)}")
+            return None
+
+    async def worker():
+        while True:
+            content, client_id = await inbox.get()
+            user_message = await turn(session.add_user_message, content)
+            if user_message is None:
+                await send({"type": "error", "detail": "Message could not be saved", "client_id": client_id})
+                continue
+            await send({"type": "message", "message": user_message, "client_id": client_id})
+            tutor_message = await turn(session.reply, content, ai_service)
+            if tutor_message is None:
+                await send({"type": "error", "detail": "Tutor could not answer", "client_id": client_id})
+                continue
+            await send({"type": "message", "message": tutor_message, "client_id": client_id})
+
+    if resume is not None:
+        await send(resume)
+
+    tasks = [asyncio.create_task(reader()), asyncio.create_task(heartbeat()), asyncio.create_task(worker())]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # Also stop the others when serve() itself is cancelled
+        for task in tasks:
+            task.cancel()
+    if pending:
+        # Not gather(): it would replace the server's own cancellation, if one
+        # arrives while waiting, with the children's
+        await asyncio.wait(pending)
+    for task in done:
+        error = task.exception()
+        if error is not None and not isinstance(error, WebSocketDisconnect):
+            print(f"WebSocket chat error: {str(error)}")
+    # The heartbeat may already have closed it, and a second close() raises;
+    # nothing can be sent either once the client has disconnected
+    if websocket.application_state == websocket.client_state == WebSocketState.CONNECTED:
+        await websocket.close(code=1011 if any(t.exception() for t in done) else 1000)
@@ -1,16 +1,59 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import BackgroundTasks, FastAPI, Depends, Header, HTTPException, Query, Response, WebSocket, status
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from typing import List, Dict, Any, Optional
 import models, schemas
 import uuid
+import os
+import secrets
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
 from database import SessionLocal, engine
 from ai_service import AITutorService
+from llm_scheduler import scheduler, SchedulerFull
+import search
+from idempotency import run_idempotent, purge_expired
+import profiling
+import learning_paths
+import chat_session
 import json
 
+_ai_service: Optional[AITutorService] = None
 
-server = FastAPI(title="Learning Platform API")
-ai_service = AITutorService()
+def get_ai_service() -> AITutorService:
+    """Return the shared AI tutor service, creating it on first use"""
+    global _ai_service
+    if _ai_service is None:
+        _ai_service = AITutorService()
+    return _ai_service
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialise heavy services once per worker and report startup time"""
+    # Covers the lifespan hook only; gunicorn_conf.py logs the full boot,
+    # including the import, from post_worker_init
+    started = time.perf_counter()
+    get_ai_service()
+    await run_in_threadpool(purge_expired)
+    app.state.startup_ms = (time.perf_counter() - started) * 1000
+    print(f"Worker {os.getpid()} ready in {app.state.startup_ms:.1f} ms")
+    yield
+    engine.dispose()
+
+server = FastAPI(title="Learning Platform API", lifespan=lifespan)
+# Must be set before any route is declared
+server.router.route_class = profiling.ProfiledRoute
+
+@server.exception_handler(SchedulerFull)
+def scheduler_full_handler(request, exc: SchedulerFull):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "5"}
+    )
 # Dependency
 def get_db():
     print("Get DB")
@@ -21,6 +64,68 @@ def get_db():
         print("Got DB")
         db.close()
 
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Allow admin routes only with the token from ADMIN_TOKEN; disabled when it is unset"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin API is disabled")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid admin token")
+
+# Health Route
+@server.get("/api/health")
+def health_check():
+    """Report worker liveness and how long the worker took to start"""
+    return {
+        "status": "ok",
+        "pid": os.getpid(),
+        "startup_ms": getattr(server.state, "startup_ms", None)
+    }
+
+@server.get("/api/admin/llm-scheduler", dependencies=[Depends(require_admin)])
+def llm_scheduler_stats():
+    """Queue depth and wait-time stats for LLM calls in this worker"""
+    return scheduler.stats()
+
+@server.get("/api/admin/profiling", response_model=schemas.ProfilingConfig, dependencies=[Depends(require_admin)])
+def get_profiling_config():
+    """Current request profiling settings, shared by all workers"""
+    profiling.config.load()
+    return profiling.config.as_dict()
+
+@server.put("/api/admin/profiling", response_model=schemas.ProfilingConfig, dependencies=[Depends(require_admin)])
+def update_profiling_config(settings: schemas.ProfilingConfig):
+    """Switch request profiling on or off at runtime for all workers"""
+    profiling.config.save(settings.enabled, settings.sample_rate, settings.route, settings.cprofile)
+    return profiling.config.as_dict()
+
+@server.get("/api/admin/profiles", dependencies=[Depends(require_admin)])
+def list_profiles(limit: int = Query(50, ge=1, le=200)):
+    """Phase timings of the most recently profiled requests across all workers"""
+    return profiling.recent_profiles(limit)
+
+@server.get("/api/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def read_profile(profile_id: int):
+    """Phase timings and the top cProfile functions for one request"""
+    profile = profiling.get_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    summary = profiling.summary(profile)
+    summary["top_functions"] = profiling.top_functions(profile) if profile.stats else None
+    return summary
+
+@server.get("/api/admin/profiles/{profile_id}/pstats", dependencies=[Depends(require_admin)])
+def download_profile(profile_id: int):
+    """Download raw cProfile stats, loadable with pstats or snakeviz"""
+    profile = profiling.get_profile(profile_id)
+    if profile is None or profile.stats is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    return Response(
+        content=profile.stats,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.prof"'}
+    )
+
 # Subject Routes
 @server.get("/api/subjects", response_model=List[schemas.Subject])
 def read_subjects(db: Session = Depends(get_db)):
@@ -53,62 +158,106 @@ def create_subject(subject: schemas.SubjectCreate, db: Session = Depends(get_db)
 
 # Learning Path Routes
 @server.get("/api/learning-plan/{subject_id}/{level}", response_model=schemas.LearningPath)
-def get_learning_path_alt(subject_id: str, level: str, db: Session = Depends(get_db)):
+def get_learning_path_alt(
+    subject_id: str,
+    level: str,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    user_id: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
     # Reuse the existing logic by redirecting to the proper endpoint
-    return get_learning_path(subject_id, level, db)
+    return get_learning_path(subject_id, level, response, background_tasks, user_id, db)
 @server.get("/api/subjects/{subject_id}/learning-plan/{level}", response_model=schemas.LearningPath)
-def get_learning_path(subject_id: str, level: str, db: Session = Depends(get_db)):
-    # Your existing implementation
+def get_learning_path(
+    subject_id: str,
+    level: str,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    user_id: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """Get the learning path for a subject and level.
+
+    Users with progress keep the version they started; everyone else gets the
+    current version. Stale versions are served immediately and regenerated in
+    the background.
+    """
     subject = db.query(models.Subject).filter(models.Subject.id == subject_id).first()
     print(":::subject::: ", subject)
     if not subject:
         raise HTTPException(status_code=404, detail="Subject not found")
-    print(":::learning_path 1:::")
-    learning_path = db.query(models.LearningPath).filter(
-        models.LearningPath.subject_id == subject_id,
-        models.LearningPath.level == level
-    ).first()
+    learning_path = None
+    if user_id:
+        learning_path = learning_paths.get_for_user(db, user_id, subject_id, level)
+    if not learning_path:
+        learning_path = learning_paths.get_current(db, subject_id, level)
     
-    print(":::learning_path 2:::", learning_path)
+    print(":::learning_path:::", learning_path)
     
     if not learning_path:
         # Generate new learning path if none exists
         print("calling learning_path")
-        learning_path_data = ai_service.generate_learning_path(subject.name, level)
+        learning_path_data = get_ai_service().generate_learning_path(subject.name, level, user_id=user_id)
         print(":::learning_path_data::: ",learning_path_data)
         
-        learning_path = models.LearningPath(
-            id=str(uuid.uuid4()),
-            subject_id=subject_id,
-            level=level,
-            structure=learning_path_data
+        learning_path = learning_paths.add_version(db, subject_id, level, learning_path_data)
+        try:
+            db.commit()
+            db.refresh(learning_path)
+        except IntegrityError:
+            # A concurrent request generated the first version; serve that one
+            db.rollback()
+            learning_path = learning_paths.get_current(db, subject_id, level)
+    elif learning_paths.needs_refresh(learning_path):
+        background_tasks.add_task(
+            learning_paths.regenerate, learning_path.id, get_ai_service().generate_learning_path
         )
-        db.add(learning_path)
-        db.commit()
-        db.refresh(learning_path)
-    print(":::final:::", learning_path)
-    print(":::final 2:::", vars(learning_path))
+        response.headers["X-Learning-Path-Stale"] = "true"
     
+    response.headers["X-Learning-Path-Id"] = learning_path.id
+    response.headers["X-Learning-Path-Version"] = str(learning_path.version)
+    return learning_path.structure
+
+@server.get("/api/learning-paths/{learning_path_id}", response_model=schemas.LearningPath)
+def read_learning_path_version(learning_path_id: str, response: Response, db: Session = Depends(get_db)):
+    """Get a specific learning path version, current or superseded"""
+    learning_path = db.query(models.LearningPath).filter(models.LearningPath.id == learning_path_id).first()
+    if learning_path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Learning path not found")
+    response.headers["X-Learning-Path-Id"] = learning_path.id
+    response.headers["X-Learning-Path-Version"] = str(learning_path.version)
     return learning_path.structure
 
 @server.post("/api/subjects/{subject_id}/learning-plan/{level}", response_model=schemas.LearningPath, status_code=status.HTTP_201_CREATED)
-def create_learning_path(subject_id: str, level: str, learning_path_data: Dict[str, Any], db: Session = Depends(get_db)):
+def create_learning_path(
+    subject_id: str,
+    level: str,
+    learning_path_data: Dict[str, Any],
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
     """Create a new learning path"""
+    return run_idempotent(
+        idempotency_key,
+        "POST /api/subjects/{subject_id}/learning-plan/{level}",
+        {"subject_id": subject_id, "level": level, "structure": learning_path_data},
+        response,
+        lambda: _create_learning_path(subject_id, level, learning_path_data, db),
+        status_code=status.HTTP_201_CREATED
+    )
+
+def _create_learning_path(subject_id: str, level: str, learning_path_data: Dict[str, Any], db: Session):
     # Check if subject exists
     db_subject = db.query(models.Subject).filter(models.Subject.id == subject_id).first()
     if db_subject is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Subject not found")
         
-    db_learning_path = models.LearningPath(
-        id=str(uuid.uuid4()),
-        subject_id=subject_id,
-        level=level,
-        structure=learning_path_data
-    )
-    db.add(db_learning_path)
-    db.commit()
+    # Becomes the current version; earlier versions stay for existing progress
+    db_learning_path = learning_paths.commit_new_version(db, subject_id, level, learning_path_data)
     db.refresh(db_learning_path)
-    return db_learning_path
+    return db_learning_path.structure
 
 # Chat Routes
 @server.post("/api/subjects/{subject_id}/chat", response_model=schemas.ChatMessage, status_code=status.HTTP_201_CREATED)
@@ -147,8 +296,23 @@ def get_chat_history(subject_id: str, limit: int = 50, db: Session = Depends(get
 
 #Chat response 
 @server.post("/api/chat", response_model=schemas.ChatMessage)
-def process_chat_message(request: schemas.ChatRequest, db: Session = Depends(get_db)):
+def process_chat_message(
+    request: schemas.ChatRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
     """Process a chat message and return AI response"""
+    return run_idempotent(
+        idempotency_key,
+        "POST /api/chat",
+        request,
+        response,
+        lambda: _process_chat_message(request, db),
+        response_schema=schemas.ChatMessage
+    )
+
+def _process_chat_message(request: schemas.ChatRequest, db: Session):
     subject_id = request.subject_id
     
     # Verify subject exists
@@ -179,10 +343,11 @@ def process_chat_message(request: schemas.ChatRequest, db: Session = Depends(get
     ]
     
     # Get AI response
-    ai_response = ai_service.get_chat_response(
+    ai_response = get_ai_service().get_chat_response(
         subject_name=db_subject.name,
         user_message=request.message,
-        chat_history=formatted_history
+        chat_history=formatted_history,
+        user_id=request.user_id
     )
     
     # Save AI response
@@ -206,9 +371,21 @@ def process_chat_message(request: schemas.ChatRequest, db: Session = Depends(get
 def get_ai_tutor_response(
     subject_id: str, 
     request: schemas.ChatRequest, 
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
     """Get AI tutor response for a user message"""
+    return run_idempotent(
+        idempotency_key,
+        "POST /api/subjects/{subject_id}/chat/response",
+        {"subject_id": subject_id, "request": request},
+        response,
+        lambda: _get_ai_tutor_response(subject_id, request, db),
+        response_schema=schemas.ChatMessage
+    )
+
+def _get_ai_tutor_response(subject_id: str, request: schemas.ChatRequest, db: Session):
     # Check if subject exists
     db_subject = db.query(models.Subject).filter(models.Subject.id == subject_id).first()
     if db_subject is None:
@@ -226,10 +403,11 @@ def get_ai_tutor_response(
     ]
     
     # Get AI response
-    ai_response = ai_service.get_chat_response(
+    ai_response = get_ai_service().get_chat_response(
         subject_name=db_subject.name,
         user_message=request.message,
-        chat_history=formatted_history
+        chat_history=formatted_history,
+        user_id=request.user_id
     )
     
     # Save AI response to database
@@ -246,10 +424,40 @@ def get_ai_tutor_response(
     
     return db_message
 
+@server.websocket("/api/ws/chat/{subject_id}")
+async def chat_websocket(
+    websocket: WebSocket,
+    subject_id: str,
+    user_id: Optional[str] = None,
+    last_message_id: Optional[str] = None
+):
+    """Persistent tutor chat; pass last_message_id to resume after a reconnect"""
+    await websocket.accept()
+    session, resume = await run_in_threadpool(chat_session.open_session, subject_id, user_id, last_message_id)
+    if session is None:
+        await websocket.close(code=4404, reason="Subject not found")
+        return
+    await chat_session.serve(websocket, session, resume, get_ai_service())
+
 # User Progress Routes
 @server.post("/api/user-progress/", response_model=schemas.UserProgress)
-def update_user_progress(progress_data: schemas.UserProgressCreate, db: Session = Depends(get_db)):
+def update_user_progress(
+    progress_data: schemas.UserProgressCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
     """Update user progress on a learning path"""
+    return run_idempotent(
+        idempotency_key,
+        "POST /api/user-progress/",
+        progress_data,
+        response,
+        lambda: _update_user_progress(progress_data, db),
+        response_schema=schemas.UserProgress
+    )
+
+def _update_user_progress(progress_data: schemas.UserProgressCreate, db: Session):
     # Check if learning path exists
     db_learning_path = db.query(models.LearningPath).filter(
         models.LearningPath.id == progress_data.learning_path_id
@@ -297,3 +505,30 @@ def get_user_progress(user_id: str, learning_path_id: str, db: Session = Depends
     
     return progress
 
+# Search Routes
+@server.get("/api/search", response_model=schemas.SearchResponse)
+def search_content(
+    q: str = Query(..., min_length=1),
+    subject_id: Optional[str] = None,
+    kind: Optional[str] = Query(None, pattern="^(chat|module)$"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db)
+):
+    """Full-text search over chat history and learning-path modules"""
+    return search.search(db, q, subject_id=subject_id, kind=kind, limit=limit, offset=offset)
+
+@server.get("/api/subjects/{subject_id}/search", response_model=schemas.SearchResponse)
+def search_subject(
+    subject_id: str,
+    q: str = Query(..., min_length=1),
+    kind: Optional[str] = Query(None, pattern="^(chat|module)$"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db)
+):
+    """Full-text search within a single subject"""
+    db_subject = db.query(models.Subject).filter(models.Subject.id == subject_id).first()
+    if db_subject is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Subject not found")
+    return search.search(db, q, subject_id=subject_id, kind=kind, limit=limit, offset=offset)
@@ -0,0 +1,52 @@
+"""Production server settings.
+
+Run with: gunicorn -c gunicorn_conf.py main:app
+
+The master applies migrations once before forking; each worker then
+imports the app and runs the lifespan hook. The app is not preloaded, so a
+HUP to the master reruns migrations and gracefully replaces all workers
+with ones running the code now on disk, which is how deploys are rolled out.
+"""
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+bind = os.getenv("BIND", "0.0.0.0:8004")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Preloading would only share the import, and HUP would keep serving the old code
+preload_app = False
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+# LLM calls can take a while; keep this above the AI service timeout
+timeout = int(os.getenv("WORKER_TIMEOUT", 60))
+keepalive = 5
+# Recycle workers periodically so slow leaks never reach production memory limits
+max_requests = int(os.getenv("MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", 100))
+
+_master_started = time.perf_counter()
+
+
+def on_starting(server):
+    from migrate import run_migrations
+    run_migrations()
+
+
+def on_reload(server):
+    # A fresh interpreter, so the migration sees the models now on disk
+    subprocess.run([sys.executable, "migrate.py"], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+
+def when_ready(server):
+    server.log.info("Master ready in %.1f ms", (time.perf_counter() - _master_started) * 1000)
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    # Includes importing the app, which each worker does for itself
+    worker.log.info("Worker %s booted in %.1f ms", worker.pid, (time.perf_counter() - worker.forked_at) * 1000)
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Callable, Optional, Tuple
+from fastapi import HTTPException, Response, status
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+import models
+from database import SessionLocal
+
+# Replayed responses are kept this long after the first request completes
+IDEMPOTENCY_TTL = timedelta(seconds=int(os.getenv("IDEMPOTENCY_TTL_SECONDS", 24 * 60 * 60)))
+# An in-progress key older than this is assumed to belong to a crashed worker
+LOCK_TIMEOUT = timedelta(seconds=int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", 120)))
+# How long a duplicate waits for the original request before giving up
+WAIT_TIMEOUT = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", 30))
+POLL_INTERVAL = 0.1
+MAX_POLL_INTERVAL = 1.0
+# Duplicates allowed to wait at once in this worker; each holds a threadpool
+# thread, so a retry storm on one slow request must not take them all
+MAX_WAITING = int(os.getenv("IDEMPOTENCY_MAX_WAITING", 8))
+RETRY_AFTER_SECONDS = 2
+# Fraction of claims that also purge expired keys
+PURGE_SAMPLE_RATE = float(os.getenv("IDEMPOTENCY_PURGE_SAMPLE_RATE", 0.01))
+
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+_waiting = 0
+_waiting_lock = threading.Lock()
+
+
+def _request_hash(payload: Any) -> str:
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def purge_expired() -> int:
+    """Delete keys whose replay window or in-progress lock has run out"""
+    db = SessionLocal()
+    try:
+        purged = db.query(models.IdempotencyKey).filter(
+            models.IdempotencyKey.expires_at < datetime.now()
+        ).delete(synchronize_session=False)
+        db.commit()
+        return purged
+    finally:
+        db.close()
+
+
+def _take_over(db, scope: str, key: str, request_hash: str, now: datetime) -> bool:
+    """Reclaim an expired or abandoned key; only one concurrent caller can win"""
+    taken = db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.scope == scope,
+        models.IdempotencyKey.key == key,
+        or_(
+            and_(models.IdempotencyKey.status == COMPLETED, models.IdempotencyKey.expires_at <= now),
+            and_(models.IdempotencyKey.status == IN_PROGRESS, models.IdempotencyKey.created_at <= now - LOCK_TIMEOUT)
+        )
+    ).update({
+        "request_hash": request_hash,
+        "status": IN_PROGRESS,
+        "status_code": None,
+        "response_body": None,
+        "created_at": now,
+        "expires_at": now + LOCK_TIMEOUT
+    }, synchronize_session=False)
+    db.commit()
+    return taken == 1
+
+
+def _claim(scope: str, key: str, request_hash: str) -> Tuple[Optional[datetime], Optional[models.IdempotencyKey]]:
+    """Try to take ownership of a key.
+
+    Returns (claimed_at, None) when this request now owns the key; claimed_at
+    identifies the claim when completing or releasing it. Otherwise returns
+    (None, record) for a key completed or in progress in another request.
+    """
+    if random.random() < PURGE_SAMPLE_RATE:
+        purge_expired()
+    db = SessionLocal()
+    try:
+        now = datetime.now()
+        record = db.query(models.IdempotencyKey).filter(
+            models.IdempotencyKey.scope == scope,
+            models.IdempotencyKey.key == key
+        ).first()
+        if record is not None:
+            expired = record.status == COMPLETED and record.expires_at <= now
+            abandoned = record.status == IN_PROGRESS and record.created_at <= now - LOCK_TIMEOUT
+            if not (expired or abandoned):
+                if record.request_hash != request_hash:
+                    raise HTTPException(
+                        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        detail="Idempotency key was already used with a different request"
+                    )
+                db.expunge(record)
+                return None, record
+            if _take_over(db, scope, key, request_hash, now):
+                return now, None
+            # Someone else reclaimed it first; look again
+            return _claim(scope, key, request_hash)
+        db.add(models.IdempotencyKey(
+            scope=scope,
+            key=key,
+            request_hash=request_hash,
+            status=IN_PROGRESS,
+            created_at=now,
+            expires_at=now + LOCK_TIMEOUT
+        ))
+        try:
+            db.commit()
+        except IntegrityError:
+            # Another request claimed it between our read and insert
+            db.rollback()
+            return _claim(scope, key, request_hash)
+        return now, None
+    finally:
+        db.close()
+
+
+def _owned(scope: str, key: str, claimed_at: datetime):
+    # A claim taken over after LOCK_TIMEOUT has a newer created_at and is left alone
+    return (
+        models.IdempotencyKey.scope == scope,
+        models.IdempotencyKey.key == key,
+        models.IdempotencyKey.status == IN_PROGRESS,
+        models.IdempotencyKey.created_at == claimed_at
+    )
+
+
+def _complete(scope: str, key: str, claimed_at: datetime, status_code: int, body: Any):
+    db = SessionLocal()
+    try:
+        now = datetime.now()
+        db.query(models.IdempotencyKey).filter(*_owned(scope, key, claimed_at)).update({
+            "status": COMPLETED,
+            "status_code": status_code,
+            "response_body": body,
+            "expires_at": now + IDEMPOTENCY_TTL
+        })
+        db.commit()
+    finally:
+        db.close()
+
+
+def _release(scope: str, key: str, claimed_at: datetime):
+    db = SessionLocal()
+    try:
+        db.query(models.IdempotencyKey).filter(*_owned(scope, key, claimed_at)).delete()
+        db.commit()
+    finally:
+        db.close()
+
+
+def _busy(detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail=detail,
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+    )
+
+
+@contextmanager
+def _waiting_slot():
+    global _waiting
+    with _waiting_lock:
+        if _waiting >= MAX_WAITING:
+            raise _busy("Too many duplicate requests are waiting; retry shortly")
+        _waiting += 1
+    try:
+        yield
+    finally:
+        with _waiting_lock:
+            _waiting -= 1
+
+
+def _wait(scope: str, key: str, request_hash: str) -> Tuple[Optional[datetime], Optional[models.IdempotencyKey]]:
+    """Poll, backing off, until the request holding a key completes or releases it"""
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    interval = POLL_INTERVAL
+    while time.monotonic() < deadline:
+        time.sleep(min(interval, max(0.0, deadline - time.monotonic())))
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+        claimed_at, existing = _claim(scope, key, request_hash)
+        if claimed_at is not None or existing.status == COMPLETED:
+            return claimed_at, existing
+    raise _busy("A request with this idempotency key is still being processed")
+
+
+def run_idempotent(
+    key: Optional[str],
+    scope: str,
+    payload: Any,
+    response: Response,
+    handler: Callable[[], Any],
+    response_schema: Any = None,
+    status_code: int = status.HTTP_200_OK
+) -> Any:
+    """Run handler at most once per idempotency key.
+
+    Without a key the handler simply runs. The first request with a key runs
+    the handler and stores its serialized response; concurrent duplicates
+    wait for it, and later duplicates replay the stored response until the
+    TTL expires. Failed requests release the key so a retry runs again.
+    Duplicates get a 409 with Retry-After when MAX_WAITING of them are
+    already waiting in this worker, or when the wait times out.
+    """
+    if not key:
+        return handler()
+
+    request_hash = _request_hash(payload)
+    claimed_at, existing = _claim(scope, key, request_hash)
+    if claimed_at is None and existing.status != COMPLETED:
+        with _waiting_slot():
+            claimed_at, existing = _wait(scope, key, request_hash)
+    if claimed_at is None:
+        response.headers["Idempotent-Replayed"] = "true"
+        response.status_code = existing.status_code
+        return existing.response_body
+
+    try:
+        result = handler()
+        if response_schema is not None and not isinstance(result, dict):
+            result = response_schema.from_orm(result)
+        body = jsonable_encoder(result)
+    except BaseException:
+        _release(scope, key, claimed_at)
+        raise
+    _complete(scope, key, claimed_at, status_code, body)
+    return body
@@ -0,0 +1,160 @@
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+from pydantic import ValidationError
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+import models, schemas
+from database import SessionLocal
+from llm_scheduler import BACKGROUND
+
+# Stored paths older than this are still served, but regenerated in the background
+MAX_AGE = timedelta(days=int(os.getenv("LEARNING_PATH_MAX_AGE_DAYS", 30)))
+# Minimum gap between regeneration attempts for the same path, across all workers
+RETRY_INTERVAL = timedelta(minutes=int(os.getenv("LEARNING_PATH_RETRY_MINUTES", 30)))
+
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+
+def get_current(db: Session, subject_id: str, level: str) -> Optional[models.LearningPath]:
+    """The version new students are given for a subject and level"""
+    return db.query(models.LearningPath).filter(
+        models.LearningPath.subject_id == subject_id,
+        models.LearningPath.level == level,
+        models.LearningPath.is_current == True
+    ).order_by(models.LearningPath.version.desc()).first()
+
+
+def get_for_user(db: Session, user_id: str, subject_id: str, level: str) -> Optional[models.LearningPath]:
+    """The version a user already has progress on, if any"""
+    return db.query(models.LearningPath).join(
+        models.UserProgress, models.UserProgress.learning_path_id == models.LearningPath.id
+    ).filter(
+        models.UserProgress.user_id == user_id,
+        models.LearningPath.subject_id == subject_id,
+        models.LearningPath.level == level
+    ).order_by(models.UserProgress.last_updated.desc()).first()
+
+
+def add_version(db: Session, subject_id: str, level: str, structure: Dict[str, Any]) -> models.LearningPath:
+    """Add a new current version, retiring the previous one in the same transaction"""
+    current = get_current(db, subject_id, level)
+    learning_path = models.LearningPath(
+        id=str(uuid.uuid4()),
+        subject_id=subject_id,
+        level=level,
+        structure=structure,
+        version=current.version + 1 if current else 1,
+        is_current=True,
+        generated_at=datetime.now()
+    )
+    if current:
+        current.is_current = False
+    db.add(learning_path)
+    return learning_path
+
+
+def commit_new_version(db: Session, subject_id: str, level: str, structure: Dict[str, Any], attempts: int = 3) -> models.LearningPath:
+    """Add and commit a new current version, retrying if another writer took the version number"""
+    for attempt in range(attempts):
+        learning_path = add_version(db, subject_id, level, structure)
+        try:
+            db.commit()
+            return learning_path
+        except IntegrityError:
+            db.rollback()
+            if attempt == attempts - 1:
+                raise
+
+
+def is_stale(learning_path: models.LearningPath) -> bool:
+    # Paths stored before versioning have no generated_at and count as stale
+    if learning_path.generated_at is None:
+        return True
+    return learning_path.generated_at < datetime.now() - MAX_AGE
+
+
+def needs_refresh(learning_path: models.LearningPath) -> bool:
+    """Whether a background regeneration should be scheduled for this path.
+
+    Checked on the row already loaded, so that requests for a stale path do
+    not each queue a claim attempt, and a write, while a refresh is running
+    or recently failed.
+    """
+    if not learning_path.is_current or not is_stale(learning_path):
+        return False
+    started = learning_path.refresh_started_at
+    if started is not None and started >= datetime.now() - RETRY_INTERVAL:
+        return False
+    with _in_flight_lock:
+        return learning_path.id not in _in_flight
+
+
+def _claim_refresh(db: Session, learning_path_id: str) -> bool:
+    """Atomically mark a current path as being refreshed; False if someone else has it"""
+    now = datetime.now()
+    claimed = db.query(models.LearningPath).filter(
+        models.LearningPath.id == learning_path_id,
+        models.LearningPath.is_current == True,
+        or_(
+            models.LearningPath.refresh_started_at == None,
+            models.LearningPath.refresh_started_at < now - RETRY_INTERVAL
+        )
+    ).update({"refresh_started_at": now}, synchronize_session=False)
+    db.commit()
+    return claimed == 1
+
+
+def regenerate(learning_path_id: str, generate: Callable[..., Optional[Dict[str, Any]]]):
+    """Regenerate a stale path and swap the new version in if it validates.
+
+    Runs as a background task with its own session. The request that noticed
+    the path was stale has already been answered with the old version.
+    """
+    with _in_flight_lock:
+        if learning_path_id in _in_flight:
+            return
+        _in_flight.add(learning_path_id)
+    db = SessionLocal()
+    try:
+        if not _claim_refresh(db, learning_path_id):
+            return
+        stale = db.query(models.LearningPath).filter(models.LearningPath.id == learning_path_id).first()
+        subject = db.query(models.Subject).filter(models.Subject.id == stale.subject_id).first()
+        if subject is None:
+            return
+        structure = generate(subject.name, stale.level, priority=BACKGROUND, allow_fallback=False)
+        if structure is None:
+            print(f"Regeneration of learning path {learning_path_id} produced no usable content")
+            return
+        try:
+            schemas.LearningPath.parse_obj(structure)
+        except ValidationError as e:
+            print(f"Regenerated learning path {learning_path_id} failed validation: {str(e)}")
+            return
+        if not structure.get("modules"):
+            print(f"Regenerated learning path {learning_path_id} has no modules")
+            return
+        db.refresh(stale)
+        if not stale.is_current:
+            # Replaced while we were generating, e.g. by create_learning_path
+            return
+        new_version = add_version(db, stale.subject_id, stale.level, structure)
+        try:
+            db.commit()
+        except IntegrityError:
+            # Another writer added a version concurrently; theirs stays current
+            db.rollback()
+            return
+        print(f"Learning path {stale.subject_id}/{stale.level} refreshed to version {new_version.version}")
+    except Exception as e:
+        db.rollback()
+        print(f"Error regenerating learning path {learning_path_id}: {str(e)}")
+    finally:
+        db.close()
+        with _in_flight_lock:
+            _in_flight.discard(learning_path_id)
@@ -0,0 +1,158 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, Optional
+from profiling import record_phase
+
+# Priority classes, highest first
+INTERACTIVE = "interactive"
+BULK = "bulk"
+BACKGROUND = "background"
+PRIORITIES = [INTERACTIVE, BULK, BACKGROUND]
+
+
+class SchedulerFull(Exception):
+    """Raised when too many calls of a priority class are already waiting"""
+
+    def __init__(self, priority: str):
+        super().__init__(f"Too many {priority} LLM calls are waiting")
+        self.priority = priority
+
+
+class _Ticket:
+    def __init__(self, priority: str, user_id: str):
+        self.priority = priority
+        self.user_id = user_id
+        self.enqueued_at = time.perf_counter()
+        self.granted = False
+
+
+class LLMScheduler:
+    """Orders LLM calls by priority class with per-class concurrency quotas.
+
+    Waiting calls are granted a slot highest priority first; within a class,
+    users are served round-robin so one user's burst cannot starve others.
+    Lower classes get smaller quotas than the total, which keeps slots free
+    for interactive chat. State is per process, so stats are per worker.
+
+    A waiting call holds a threadpool thread, so the number of waiting calls
+    in the lower classes is capped; past the cap run() raises SchedulerFull
+    instead of queueing, leaving threads free for interactive requests.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        quotas: Optional[Dict[str, int]] = None,
+        max_waiting: Optional[Dict[str, int]] = None
+    ):
+        self.max_concurrency = max_concurrency
+        self.quotas = {
+            INTERACTIVE: max_concurrency,
+            BULK: max(1, max_concurrency // 2),
+            BACKGROUND: max(1, max_concurrency // 4),
+        }
+        if quotas:
+            self.quotas.update(quotas)
+        # None means unbounded; interactive chat is never rejected
+        self.max_waiting = {INTERACTIVE: None, BULK: 16, BACKGROUND: 8}
+        if max_waiting:
+            self.max_waiting.update(max_waiting)
+        self._cond = threading.Condition()
+        self._waiting = {p: OrderedDict() for p in PRIORITIES}
+        self._running = {p: 0 for p in PRIORITIES}
+        self._started = {p: 0 for p in PRIORITIES}
+        self._completed = {p: 0 for p in PRIORITIES}
+        self._rejected = {p: 0 for p in PRIORITIES}
+        self._wait_total = {p: 0.0 for p in PRIORITIES}
+        self._wait_max = {p: 0.0 for p in PRIORITIES}
+
+    def run(self, priority: str, user_id: Optional[str], fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Block until a slot is granted for this call, then run it"""
+        if priority not in self._waiting:
+            raise ValueError(f"Unknown priority class: {priority}")
+        ticket = _Ticket(priority, user_id or "anonymous")
+        with self._cond:
+            limit = self.max_waiting[priority]
+            if limit is not None and self._queued(priority) >= limit:
+                self._rejected[priority] += 1
+                raise SchedulerFull(priority)
+            self._waiting[priority].setdefault(ticket.user_id, deque()).append(ticket)
+            self._dispatch()
+            while not ticket.granted:
+                self._cond.wait()
+            waited = time.perf_counter() - ticket.enqueued_at
+            self._started[priority] += 1
+            self._wait_total[priority] += waited
+            self._wait_max[priority] = max(self._wait_max[priority], waited)
+        record_phase("llm_queue", waited)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._cond:
+                self._running[priority] -= 1
+                self._completed[priority] += 1
+                self._dispatch()
+
+    def _queued(self, priority: str) -> int:
+        return sum(len(t) for t in self._waiting[priority].values())
+
+    def _dispatch(self):
+        """Grant free slots to waiting tickets; caller must hold the lock"""
+        granted_any = False
+        while sum(self._running.values()) < self.max_concurrency:
+            ticket = self._next_ticket()
+            if ticket is None:
+                break
+            ticket.granted = True
+            self._running[ticket.priority] += 1
+            granted_any = True
+        if granted_any:
+            self._cond.notify_all()
+
+    def _next_ticket(self) -> Optional[_Ticket]:
+        for priority in PRIORITIES:
+            users = self._waiting[priority]
+            if not users or self._running[priority] >= self.quotas[priority]:
+                continue
+            # Round-robin: take from the first user, then move them to the back
+            user_id, tickets = next(iter(users.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            return ticket
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth, running calls and wait times for each priority class"""
+        with self._cond:
+            classes = {}
+            for priority in PRIORITIES:
+                started = self._started[priority]
+                classes[priority] = {
+                    "queued": self._queued(priority),
+                    "max_waiting": self.max_waiting[priority],
+                    "running": self._running[priority],
+                    "quota": self.quotas[priority],
+                    "completed": self._completed[priority],
+                    "rejected": self._rejected[priority],
+                    "avg_wait_ms": round(self._wait_total[priority] / started * 1000, 2) if started else 0.0,
+                    "max_wait_ms": round(self._wait_max[priority] * 1000, 2),
+                }
+            return {
+                "pid": os.getpid(),
+                "max_concurrency": self.max_concurrency,
+                "classes": classes,
+            }
+
+
+scheduler = LLMScheduler(
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 8)),
+    max_waiting={
+        BULK: int(os.getenv("LLM_MAX_WAITING_BULK", 16)),
+        BACKGROUND: int(os.getenv("LLM_MAX_WAITING_BACKGROUND", 8)),
+    }
+)
@@ -1,13 +1,9 @@
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-import models
-from database import engine
 from crud import server as app
 
 server = FastAPI(title="Learning Platform API")
-# Create tables
-models.Base.metadata.create_all(bind=engine)
 
 # Add CORS middleware
 app.add_middleware(
@@ -19,5 +15,6 @@ app.add_middleware(
 )
 
 if __name__ == "__main__":
+    # Development server; run migrate.py first. Use gunicorn_conf.py in production.
     uvicorn.run("main:app", host="0.0.0.0", port=8004, reload=True)
     
\ No newline at end of file
@@ -0,0 +1,76 @@
+import time
+from sqlalchemy import inspect, text
+import models
+from database import engine
+from search import MODULE, _delete_rows, create_search_index, ensure_search_index
+
+
+def _default_sql(column, dialect) -> str:
+    """Render a column's server default for ALTER TABLE ... ADD COLUMN"""
+    arg = column.server_default.arg
+    if isinstance(arg, str):
+        return "'" + arg.replace("'", "''") + "'"
+    if dialect.name == "sqlite":
+        # SQLite only accepts constant defaults on added columns
+        raise ValueError(
+            f"Cannot add {column.table.name}.{column.name} with non-literal default {arg} on SQLite"
+        )
+    return str(arg.compile(dialect=dialect))
+
+
+def _number_learning_path_versions(connection):
+    # Rows stored before versioning all default to version 1, which the unique
+    # version index would reject; number them by age and keep the newest current
+    duplicated = connection.execute(text("""
+        SELECT subject_id, level FROM learning_paths
+        GROUP BY subject_id, level, version HAVING COUNT(*) > 1
+    """)).all()
+    for subject_id, level in set(duplicated):
+        ids = connection.execute(text("""
+            SELECT id FROM learning_paths WHERE subject_id = :subject_id AND level = :level
+            ORDER BY version, created_at, id
+        """), {"subject_id": subject_id, "level": level}).scalars().all()
+        for version, learning_path_id in enumerate(ids, start=1):
+            connection.execute(
+                text("UPDATE learning_paths SET version = :version, is_current = :is_current WHERE id = :id"),
+                {"version": version, "is_current": version == len(ids), "id": learning_path_id}
+            )
+            if version < len(ids):
+                _delete_rows(connection, MODULE, learning_path_id)
+
+
+def _add_missing_columns(connection):
+    """Add columns and indexes declared on models but missing from existing tables"""
+    inspector = inspect(connection)
+    tables = models.Base.metadata.sorted_tables
+    for table in tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=connection.dialect)}"
+            if column.server_default is not None:
+                ddl += f" DEFAULT {_default_sql(column, connection.dialect)}"
+            connection.execute(text(ddl))
+    _number_learning_path_versions(connection)
+    for table in tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def run_migrations():
+    """Create database tables once, before any worker starts serving"""
+    started = time.perf_counter()
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        # Renumbering old learning paths drops retired ones from the index
+        create_search_index(connection)
+        _add_missing_columns(connection)
+        ensure_search_index(connection)
+    # Drop the pooled connection so forked workers open their own
+    engine.dispose()
+    print(f"Migrations applied in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    run_migrations()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, ForeignKey, JSON, DateTime, Text
+from sqlalchemy import Column, String, Integer, ForeignKey, JSON, DateTime, Text, Boolean, Index, Float, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 
@@ -22,6 +22,17 @@ class LearningPath(Base):
     level = Column(String, nullable=False)  # beginner, intermediate, advanced
     structure = Column(JSON, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Each regeneration adds a new row; older versions stay for existing UserProgress
+    version = Column(Integer, nullable=False, server_default="1")
+    is_current = Column(Boolean, nullable=False, server_default="1")
+    generated_at = Column(DateTime, nullable=True)
+    refresh_started_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index("ix_learning_paths_current", "subject_id", "level", "is_current"),
+        # Two writers that both read version N cannot both add N + 1
+        Index("ux_learning_paths_version", "subject_id", "level", "version", unique=True),
+    )
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
@@ -40,4 +51,41 @@ class UserProgress(Base):
     user_id = Column(String, nullable=False)  # Could link to auth system
     learning_path_id = Column(String, ForeignKey("learning_paths.id"))
     progress_data = Column(JSON, nullable=False)
-    last_updated = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
\ No newline at end of file
+    last_updated = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    
+    scope = Column(String, primary_key=True)  # method and route the key was used on
+    key = Column(String, primary_key=True)
+    request_hash = Column(String, nullable=False)
+    status = Column(String, nullable=False)  # in_progress or completed
+    status_code = Column(Integer, nullable=True)
+    response_body = Column(JSON, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class ProfilingSettings(Base):
+    __tablename__ = "profiling_settings"
+    
+    id = Column(Integer, primary_key=True)  # single row, id 1
+    enabled = Column(Boolean, nullable=False)
+    sample_rate = Column(Float, nullable=False)
+    route = Column(String, nullable=True)
+    cprofile = Column(Boolean, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+class RequestProfile(Base):
+    __tablename__ = "request_profiles"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    pid = Column(Integer, nullable=False)  # worker that served the request
+    method = Column(String, nullable=False)
+    route = Column(String, nullable=False)
+    path = Column(String, nullable=False)
+    started_at = Column(DateTime, nullable=False)
+    status_code = Column(Integer, nullable=True)
+    duration_ms = Column(Float, nullable=False)
+    phases_ms = Column(JSON, nullable=False)
+    phase_counts = Column(JSON, nullable=False)
+    stats = Column(LargeBinary, nullable=True)  # marshalled cProfile stats
\ No newline at end of file
@@ -0,0 +1,311 @@
+import cProfile
+import functools
+import inspect
+import io
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+import fastapi.routing
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.concurrency import run_in_threadpool
+import models
+from database import SessionLocal
+
+# Settings and captured profiles live in the database so every worker sees
+# the same switch and any worker can serve any profile. Each worker re-reads
+# the settings at most every CONFIG_TTL seconds. While profiling is off, the
+# cost on a request is that cached check plus one ContextVar lookup at each
+# instrumented phase.
+
+CONFIG_TTL = float(os.getenv("PROFILING_CONFIG_TTL_SECONDS", 2))
+# Profiles kept across all workers; older ones are trimmed on insert
+KEEP = int(os.getenv("PROFILING_KEEP", 200))
+
+
+class ProfilerConfig:
+    def __init__(self):
+        # Used until the settings are first saved through the admin API
+        self.enabled = os.getenv("PROFILING_ENABLED", "").lower() in ("1", "true", "yes")
+        self.sample_rate = float(os.getenv("PROFILING_SAMPLE_RATE", 0.01))
+        self.route: Optional[str] = os.getenv("PROFILING_ROUTE") or None  # route template, e.g. /api/chat
+        self.cprofile = True
+        self.loaded_at: Optional[float] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "route": self.route,
+            "cprofile": self.cprofile,
+        }
+
+    def is_fresh(self) -> bool:
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < CONFIG_TTL
+
+    def _apply(self, settings: Optional[models.ProfilingSettings]):
+        if settings is not None:
+            self.enabled = settings.enabled
+            self.sample_rate = settings.sample_rate
+            self.route = settings.route
+            self.cprofile = settings.cprofile
+        self.loaded_at = time.monotonic()
+
+    def load(self):
+        """Re-read the shared settings"""
+        db = SessionLocal()
+        try:
+            self._apply(db.get(models.ProfilingSettings, 1))
+        finally:
+            db.close()
+
+    def save(self, enabled: bool, sample_rate: float, route: Optional[str], cprofile: bool):
+        """Store new settings for all workers; others pick them up within CONFIG_TTL"""
+        db = SessionLocal()
+        try:
+            settings = db.merge(models.ProfilingSettings(
+                id=1,
+                enabled=enabled,
+                sample_rate=sample_rate,
+                route=route,
+                cprofile=cprofile,
+                updated_at=datetime.now()
+            ))
+            db.commit()
+            self._apply(settings)
+        finally:
+            db.close()
+
+
+class ActiveProfile:
+    """Timings collected while one sampled request is in flight"""
+
+    def __init__(self, method: str, route: str, path: str):
+        self.method = method
+        self.route = route
+        self.path = path
+        self.started_at = datetime.now()
+        self.duration_ms = 0.0
+        self.status_code: Optional[int] = None
+        self.phases: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.stats: Optional[bytes] = None
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds * 1000
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+
+    def store(self):
+        """Save the finished profile, tagged with this worker's pid"""
+        db = SessionLocal()
+        try:
+            stored = models.RequestProfile(
+                pid=os.getpid(),
+                method=self.method,
+                route=self.route,
+                path=self.path,
+                started_at=self.started_at,
+                status_code=self.status_code,
+                duration_ms=round(self.duration_ms, 2),
+                phases_ms={name: round(ms, 2) for name, ms in self.phases.items()},
+                phase_counts=self.counts,
+                stats=self.stats
+            )
+            db.add(stored)
+            db.flush()
+            db.query(models.RequestProfile).filter(
+                models.RequestProfile.id <= stored.id - KEEP
+            ).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+
+def summary(profile: models.RequestProfile) -> Dict[str, Any]:
+    return {
+        "id": profile.id,
+        "pid": profile.pid,
+        "method": profile.method,
+        "route": profile.route,
+        "path": profile.path,
+        "started_at": profile.started_at,
+        "status_code": profile.status_code,
+        "duration_ms": profile.duration_ms,
+        "phases_ms": profile.phases_ms,
+        "phase_counts": profile.phase_counts,
+        "has_cprofile": profile.stats is not None,
+    }
+
+
+config = ProfilerConfig()
+_current: ContextVar[Optional[ActiveProfile]] = ContextVar("current_profile", default=None)
+# Only one cProfile can be active per process at a time
+_cprofile_lock = threading.Lock()
+
+
+def record_phase(phase: str, seconds: float):
+    """Add time spent in a phase to the current request's profile, if any"""
+    profile = _current.get()
+    if profile is not None:
+        profile.add(phase, seconds)
+
+
+@contextmanager
+def phase(name: str):
+    """Time the enclosed block as a phase of the current request"""
+    if _current.get() is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - started)
+
+
+def recent_profiles(limit: int = 50) -> List[Dict[str, Any]]:
+    """Most recent profiles from all workers, newest first"""
+    db = SessionLocal()
+    try:
+        return [
+            summary(profile) for profile in db.query(models.RequestProfile).order_by(
+                models.RequestProfile.id.desc()
+            ).limit(limit).all()
+        ]
+    finally:
+        db.close()
+
+
+def get_profile(profile_id: int) -> Optional[models.RequestProfile]:
+    db = SessionLocal()
+    try:
+        return db.get(models.RequestProfile, profile_id)
+    finally:
+        db.close()
+
+
+def top_functions(profile: models.RequestProfile, limit: int = 30) -> str:
+    """Render the cProfile stats of a request, sorted by cumulative time"""
+    stats = pstats.Stats(_StatsSource(profile.stats), stream=io.StringIO())
+    stats.sort_stats("cumulative").print_stats(limit)
+    return stats.stream.getvalue()
+
+
+class _StatsSource:
+    # pstats.Stats accepts any object with create_stats() and a stats dict
+    def __init__(self, data: bytes):
+        self.stats = marshal.loads(data)
+
+    def create_stats(self):
+        pass
+
+
+def _should_sample(route: str) -> bool:
+    if config.route is not None and config.route != route:
+        return False
+    return config.route is not None or random.random() < config.sample_rate
+
+
+def _wrap_endpoint(endpoint: Callable) -> Callable:
+    """Time the endpoint body and run it under cProfile when sampled"""
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return await endpoint(*args, **kwargs)
+            with phase("endpoint"):
+                return await endpoint(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        profile = _current.get()
+        if profile is None:
+            return endpoint(*args, **kwargs)
+        with phase("endpoint"):
+            if not config.cprofile or not _cprofile_lock.acquire(blocking=False):
+                return endpoint(*args, **kwargs)
+            try:
+                profiler = cProfile.Profile()
+                try:
+                    return profiler.runcall(endpoint, *args, **kwargs)
+                finally:
+                    profiler.create_stats()
+                    profile.stats = marshal.dumps(profiler.stats)
+            finally:
+                _cprofile_lock.release()
+    return wrapper
+
+
+_serialize_response = fastapi.routing.serialize_response
+
+
+async def _timed_serialize_response(**kwargs):
+    with phase("serialization"):
+        return await _serialize_response(**kwargs)
+
+
+# FastAPI looks serialize_response up as a module global on every request
+fastapi.routing.serialize_response = _timed_serialize_response
+
+
+class ProfiledRoute(APIRoute):
+    """Route class that profiles a sampled fraction of requests.
+
+    "endpoint" covers the route function itself and "serialization" the
+    response model's validation and encoding. "framework" is the remainder:
+    request parsing, dependencies such as get_db, and threadpool queueing.
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, _wrap_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        route = self.path
+
+        async def profiled_handler(request):
+            if not config.is_fresh():
+                await run_in_threadpool(config.load)
+            if not config.enabled or not _should_sample(route):
+                return await handler(request)
+            profile = ActiveProfile(request.method, route, request.url.path)
+            token = _current.set(profile)
+            started = time.perf_counter()
+            try:
+                response = await handler(request)
+                profile.status_code = response.status_code
+                return response
+            finally:
+                _current.reset(token)
+                profile.duration_ms = (time.perf_counter() - started) * 1000
+                profile.phases["framework"] = max(
+                    0.0,
+                    profile.duration_ms
+                    - profile.phases.get("endpoint", 0.0)
+                    - profile.phases.get("serialization", 0.0)
+                )
+                await run_in_threadpool(profile.store)
+
+        return profiled_handler
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _db_started(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _db_finished(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("profile_query_start")
+    if starts:
+        record_phase("db", time.perf_counter() - starts.pop())
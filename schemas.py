@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 
@@ -18,6 +18,7 @@ class Subject(SubjectBase):
     
     class Config:
         orm_mode = True
+        from_attributes = True
 
 class LearningModule(BaseModel):
     id: int
@@ -37,6 +38,7 @@ class LearningPath(BaseModel):
     
     class Config:
         orm_mode = True
+        from_attributes = True
 
 class ChatMessageBase(BaseModel):
     content: str
@@ -46,6 +48,7 @@ class ChatMessageBase(BaseModel):
 class ChatRequest(BaseModel):
     subject_id: str
     message: str
+    user_id: Optional[str] = None
 
 class ChatMessage(ChatMessageBase):
     id: str
@@ -54,6 +57,7 @@ class ChatMessage(ChatMessageBase):
     
     class Config:
         orm_mode = True
+        from_attributes = True
 
 class UserProgressBase(BaseModel):
     user_id: str
@@ -68,4 +72,28 @@ class UserProgress(UserProgressBase):
     last_updated: datetime
     
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+        from_attributes = True
+
+class SearchResult(BaseModel):
+    kind: str  # 'chat' or 'module'
+    id: str  # chat message id or learning path id
+    module_id: Optional[str] = None
+    subject_id: Optional[str] = None
+    title: str
+    snippet: str
+    score: float
+
+class SearchResponse(BaseModel):
+    query: str
+    total: int
+    limit: int
+    offset: int
+    took_ms: float
+    results: List[SearchResult]
+
+class ProfilingConfig(BaseModel):
+    enabled: bool = False
+    sample_rate: float = Field(0.01, ge=0.0, le=1.0)
+    route: Optional[str] = None  # profile every request to this route template
+    cprofile: bool = True
\ No newline at end of file
@@ -0,0 +1,375 @@
+import re
+import time
+from typing import Any, Dict, List, Optional
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+import models
+
+# One index holds both chat messages and learning-path modules. On SQLite
+# it is an FTS5 virtual table; on Postgres a plain table with a weighted
+# tsvector column and a GIN index. Rows are written by ORM events in the
+# same transaction as the source row, so the index never lags behind.
+#
+# The SQLite table is unstemmed, so that a partially typed last word can
+# prefix-match ("derivat" against "derivatives"); a porter stem would not.
+# Complete words are trimmed of common suffixes and prefix-matched too,
+# which covers most of what stemming did. FTS5 cannot index UNINDEXED
+# columns, so search_index_refs maps (kind, ref_id) to rowids for cheap
+# deletes. Subject and kind filters are part of the MATCH expression, so
+# they never read stored rows either.
+
+CHAT = "chat"
+MODULE = "module"
+
+_SQLITE_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        title,
+        body,
+        kind,
+        ref_id UNINDEXED,
+        module_id UNINDEXED,
+        subject_id,
+        tokenize = 'unicode61',
+        prefix = '2 3 4'
+    )
+    """,
+    # Titles weigh twice as much as bodies in ORDER BY rank; kind and
+    # subject_id are indexed only so filters are answered from the index
+    "INSERT INTO search_index (search_index, rank) VALUES ('rank', 'bm25(2.0, 1.0, 0.0, 0.0, 0.0, 0.0)')",
+    """
+    CREATE TABLE IF NOT EXISTS search_index_refs (
+        kind VARCHAR NOT NULL,
+        ref_id VARCHAR NOT NULL,
+        doc_rowid INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_search_index_refs ON search_index_refs (kind, ref_id)",
+]
+
+_POSTGRES_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS search_index (
+        rowid BIGSERIAL PRIMARY KEY,
+        title TEXT NOT NULL DEFAULT '',
+        body TEXT NOT NULL DEFAULT '',
+        kind VARCHAR NOT NULL,
+        ref_id VARCHAR NOT NULL,
+        module_id VARCHAR,
+        subject_id VARCHAR,
+        document TSVECTOR NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_search_index_document ON search_index USING GIN (document)",
+    "CREATE INDEX IF NOT EXISTS ix_search_index_ref ON search_index (kind, ref_id)",
+]
+
+_SQLITE_INSERT = text("""
+    INSERT INTO search_index (title, body, kind, ref_id, module_id, subject_id)
+    VALUES (:title, :body, :kind, :ref_id, :module_id, :subject_id)
+""")
+
+_SQLITE_INSERT_REF = text("INSERT INTO search_index_refs (kind, ref_id, doc_rowid) VALUES (:kind, :ref_id, :rowid)")
+
+_SQLITE_DELETE = [
+    text("""
+        DELETE FROM search_index WHERE rowid IN (
+            SELECT doc_rowid FROM search_index_refs WHERE kind = :kind AND ref_id = :ref_id
+        )
+    """),
+    text("DELETE FROM search_index_refs WHERE kind = :kind AND ref_id = :ref_id"),
+]
+
+_POSTGRES_INSERT = text("""
+    INSERT INTO search_index (title, body, kind, ref_id, module_id, subject_id, document)
+    VALUES (
+        :title, :body, :kind, :ref_id, :module_id, :subject_id,
+        setweight(to_tsvector('english', :title), 'A') || setweight(to_tsvector('english', :body), 'B')
+    )
+""")
+
+_POSTGRES_DELETE = text("DELETE FROM search_index WHERE kind = :kind AND ref_id = :ref_id")
+
+# The page is ranked and limited first; snippets are only built for its rows
+_SQLITE_QUERY = text("""
+    WITH page AS MATERIALIZED (
+        SELECT rowid, rank
+        FROM search_index
+        WHERE search_index MATCH :match
+        ORDER BY rank
+        LIMIT :limit OFFSET :offset
+    )
+    SELECT kind, ref_id, module_id, subject_id, title,
+           snippet(search_index, 1, '<b>', '</b>', '...', 12) AS snippet,
+           -page.rank AS score
+    FROM page
+    JOIN search_index ON search_index.rowid = page.rowid
+    WHERE search_index MATCH :match
+    ORDER BY page.rank
+""")
+
+_SQLITE_COUNT = text("""
+    SELECT COUNT(*) FROM search_index WHERE search_index MATCH :match
+""")
+
+_POSTGRES_QUERY = text("""
+    SELECT kind, ref_id, module_id, subject_id, title,
+           ts_headline('english', body, q, 'StartSel=<b>, StopSel=</b>, MaxWords=24') AS snippet,
+           score
+    FROM (
+        SELECT kind, ref_id, module_id, subject_id, title, body, q, ts_rank(document, q) AS score
+        FROM search_index, to_tsquery('english', :match) AS q
+        WHERE document @@ q
+          AND (CAST(:subject_id AS VARCHAR) IS NULL OR subject_id = :subject_id)
+          AND (CAST(:kind AS VARCHAR) IS NULL OR kind = :kind)
+        ORDER BY score DESC
+        LIMIT :limit OFFSET :offset
+    ) AS page
+    ORDER BY score DESC
+""")
+
+_POSTGRES_COUNT = text("""
+    SELECT COUNT(*)
+    FROM search_index, to_tsquery('english', :match) AS q
+    WHERE document @@ q
+      AND (CAST(:subject_id AS VARCHAR) IS NULL OR subject_id = :subject_id)
+      AND (CAST(:kind AS VARCHAR) IS NULL OR kind = :kind)
+""")
+
+# Runs of letters and digits, as unicode61 splits them; everything else,
+# including FTS5 and tsquery syntax, only separates terms
+_TERM = re.compile(r"[^\W_]+")
+_SUFFIXES = ("ing", "es", "ed", "s")
+
+
+def _is_sqlite(connection) -> bool:
+    return connection.dialect.name == "sqlite"
+
+
+def _drop_stemmed_sqlite_index(connection):
+    # Earlier builds kept a porter-stemmed table, later with an unstemmed copy
+    # beside it; drop both so the index is rebuilt as the single table above
+    legacy = connection.execute(text(
+        "SELECT sql FROM sqlite_master WHERE name = 'search_index'"
+    )).scalar()
+    if legacy and "porter" in legacy:
+        for table in ("search_index", "search_prefix", "search_index_refs"):
+            connection.execute(text(f"DROP TABLE IF EXISTS {table}"))
+
+
+def create_search_index(connection):
+    """Create the full-text index table for the connected database"""
+    if _is_sqlite(connection):
+        _drop_stemmed_sqlite_index(connection)
+    for ddl in (_SQLITE_DDL if _is_sqlite(connection) else _POSTGRES_DDL):
+        connection.execute(text(ddl))
+
+
+def _module_rows(learning_path: models.LearningPath) -> List[Dict[str, Any]]:
+    # Superseded versions are dropped from the index when they stop being current
+    if learning_path.is_current is False:
+        return []
+    structure = learning_path.structure or {}
+    rows = []
+    for module in structure.get("modules", []):
+        if not isinstance(module, dict):
+            continue
+        objectives = module.get("objectives") or []
+        rows.append({
+            "title": module.get("title") or "",
+            "body": " ".join([module.get("description") or ""] + [str(o) for o in objectives]),
+            "kind": MODULE,
+            "ref_id": learning_path.id,
+            "module_id": str(module.get("id", "")),
+            "subject_id": learning_path.subject_id,
+        })
+    return rows
+
+
+def _chat_row(message: models.ChatMessage) -> Dict[str, Any]:
+    return {
+        "title": "",
+        "body": message.content or "",
+        "kind": CHAT,
+        "ref_id": message.id,
+        "module_id": None,
+        "subject_id": message.subject_id,
+    }
+
+
+def _insert_rows(connection, rows: List[Dict[str, Any]]):
+    if not rows:
+        return
+    if not _is_sqlite(connection):
+        connection.execute(_POSTGRES_INSERT, rows)
+        return
+    for row in rows:
+        rowid = connection.execute(_SQLITE_INSERT, row).lastrowid
+        connection.execute(_SQLITE_INSERT_REF, {"kind": row["kind"], "ref_id": row["ref_id"], "rowid": rowid})
+
+
+def _delete_rows(connection, kind: str, ref_id: str):
+    params = {"kind": kind, "ref_id": ref_id}
+    if _is_sqlite(connection):
+        for statement in _SQLITE_DELETE:
+            connection.execute(statement, params)
+    else:
+        connection.execute(_POSTGRES_DELETE, params)
+
+
+def rebuild_search_index(connection):
+    """Re-index every chat message and learning path from scratch"""
+    connection.execute(text("DELETE FROM search_index"))
+    if _is_sqlite(connection):
+        connection.execute(text("DELETE FROM search_index_refs"))
+    session = Session(bind=connection)
+    try:
+        _insert_rows(connection, [_chat_row(m) for m in session.query(models.ChatMessage).all()])
+        for learning_path in session.query(models.LearningPath).all():
+            _insert_rows(connection, _module_rows(learning_path))
+    finally:
+        session.close()
+
+
+def ensure_search_index(connection):
+    """Create the index if needed and backfill it when it starts out empty"""
+    create_search_index(connection)
+    # On SQLite an index built before search_index_refs existed has no refs
+    table = "search_index_refs" if _is_sqlite(connection) else "search_index"
+    if connection.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar() == 0:
+        rebuild_search_index(connection)
+
+
+def _terms(query: str) -> List[str]:
+    return _TERM.findall(query.lower())
+
+
+def _trim_suffix(term: str) -> str:
+    for suffix in _SUFFIXES:
+        if term.endswith(suffix) and len(term) - len(suffix) >= 4:
+            return term[:-len(suffix)]
+    return term
+
+
+def _fts5_query(query: str) -> str:
+    """Build one FTS5 expression requiring every term of the query.
+
+    Each term matches as a prefix once common suffixes are trimmed, so
+    "pointers" finds "pointer" and a partly typed last term finds the whole
+    word. The last term needs two characters to be a prefix, others three.
+    Terms are quoted, so user input can never be parsed as FTS5 syntax.
+    """
+    terms = _terms(query)
+    if not terms:
+        return ""
+    parts = []
+    for term in terms[:-1]:
+        stem = _trim_suffix(term)
+        parts.append(_quote(stem) + "*" if len(stem) >= 3 else _quote(stem))
+    last = _trim_suffix(terms[-1])
+    parts.append(_quote(last) + "*" if len(last) >= 2 else _quote(last))
+    # Only the text columns; kind and subject_id are indexed for filtering
+    return "{title body} : (" + " ".join(parts) + ")"
+
+
+def _quote(value: str) -> str:
+    return '"' + value.replace('"', '""') + '"'
+
+
+def _fts5_filter(match: str, subject_id: Optional[str], kind: Optional[str]) -> str:
+    """Restrict an FTS5 expression to a subject and kind"""
+    if subject_id is not None:
+        match += f" AND subject_id : {_quote(subject_id)}"
+    if kind is not None:
+        match += f" AND kind : {_quote(kind)}"
+    return match
+
+
+def _tsquery(query: str) -> str:
+    """Build a to_tsquery expression requiring every term, the last as a prefix.
+
+    Postgres stems the prefix as well, so unlike SQLite a partial word only
+    matches while it is no longer than its stem ("deriv" but not "derivat").
+    """
+    terms = _terms(query)
+    if not terms:
+        return ""
+    return " & ".join(terms[:-1] + [terms[-1] + ":*"])
+
+
+def search(
+    db: Session,
+    query: str,
+    subject_id: Optional[str] = None,
+    kind: Optional[str] = None,
+    limit: int = 20,
+    offset: int = 0
+) -> Dict[str, Any]:
+    """Run a ranked full-text query over chat history and learning-path modules"""
+    started = time.perf_counter()
+    connection = db.connection()
+    if _is_sqlite(connection):
+        match = _fts5_query(query)
+        if match:
+            match = _fts5_filter(match, subject_id, kind)
+        statement, count = _SQLITE_QUERY, _SQLITE_COUNT
+    else:
+        statement, count, match = _POSTGRES_QUERY, _POSTGRES_COUNT, _tsquery(query)
+    params = {"match": match, "subject_id": subject_id, "kind": kind}
+    results = []
+    total = 0
+    if match:
+        total = connection.execute(count, params).scalar()
+    if total > offset:
+        rows = connection.execute(statement, dict(params, limit=limit, offset=offset)).mappings().all()
+        results = [
+            {
+                "kind": row["kind"],
+                "id": row["ref_id"],
+                "module_id": row["module_id"],
+                "subject_id": row["subject_id"],
+                "title": row["title"],
+                "snippet": row["snippet"],
+                "score": float(row["score"]),
+            }
+            for row in rows
+        ]
+    return {
+        "query": query,
+        "total": total,
+        "limit": limit,
+        "offset": offset,
+        "took_ms": round((time.perf_counter() - started) * 1000, 2),
+        "results": results,
+    }
+
+
+# Keep the index current on every write
+
+@event.listens_for(models.ChatMessage, "after_insert")
+def _index_chat_message(mapper, connection, target):
+    _insert_rows(connection, [_chat_row(target)])
+
+
+@event.listens_for(models.ChatMessage, "after_delete")
+def _unindex_chat_message(mapper, connection, target):
+    _delete_rows(connection, CHAT, target.id)
+
+
+@event.listens_for(models.LearningPath, "after_insert")
+def _index_learning_path(mapper, connection, target):
+    _insert_rows(connection, _module_rows(target))
+
+
+@event.listens_for(models.LearningPath, "after_update")
+def _reindex_learning_path(mapper, connection, target):
+    state = inspect(target)
+    if not (state.attrs.structure.history.has_changes() or state.attrs.is_current.history.has_changes()):
+        return
+    _delete_rows(connection, MODULE, target.id)
+    _insert_rows(connection, _module_rows(target))
+
+
+@event.listens_for(models.LearningPath, "after_delete")
+def _unindex_learning_path(mapper, connection, target):
+    _delete_rows(connection, MODULE, target.id)
@@ -1,12 +1,10 @@
 import os
 from sqlalchemy.orm import Session
 import models, schemas
-from database import SessionLocal, engine
+from database import SessionLocal
+from migrate import run_migrations
 import uuid
 
-# Create database tables
-models.Base.metadata.create_all(bind=engine)
-
 def seed_subjects():
     db = SessionLocal()
     
@@ -66,4 +64,5 @@ def seed_subjects():
     db.close()
 
 if __name__ == "__main__":
+    run_migrations()
     seed_subjects()
\ No newline at end of file
@@ -0,0 +1,45 @@
+import os
+import sys
+import tempfile
+import uuid
+
+# Point the app at a throwaway database before anything imports database.py
+_db_dir = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+os.environ.pop("OPENAI_API_KEY", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def migrated():
+    from migrate import run_migrations
+    run_migrations()
+
+
+@pytest.fixture
+def db(migrated):
+    from database import SessionLocal
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def subject(db):
+    import models
+    db_subject = models.Subject(id=str(uuid.uuid4()), name="Mathematics")
+    db.add(db_subject)
+    db.commit()
+    return db_subject
+
+
+@pytest.fixture
+def client(migrated):
+    from fastapi.testclient import TestClient
+    from crud import server
+    with TestClient(server) as test_client:
+        yield test_client
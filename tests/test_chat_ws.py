@@ -0,0 +1,96 @@
+import pytest
+from starlette.websockets import WebSocketDisconnect
+import chat_session
+
+
+def _url(subject, **params):
+    query = "&".join(f"{name}={value}" for name, value in params.items())
+    return f"/api/ws/chat/{subject.id}" + (f"?{query}" if query else "")
+
+
+def test_message_gets_saved_message_and_tutor_answer(client, subject):
+    with client.websocket_connect(_url(subject)) as ws:
+        ws.send_json({"type": "message", "content": "What is a limit?", "client_id": "c1"})
+        saved = ws.receive_json()
+        answer = ws.receive_json()
+    assert saved["type"] == answer["type"] == "message"
+    assert saved["client_id"] == answer["client_id"] == "c1"
+    assert saved["message"]["sender"] == "user"
+    assert saved["message"]["content"] == "What is a limit?"
+    assert answer["message"]["sender"] == "tutor"
+
+
+def test_resume_sends_missed_messages(client, subject):
+    with client.websocket_connect(_url(subject)) as ws:
+        ws.send_json({"type": "message", "content": "First question", "client_id": "c1"})
+        last_seen = ws.receive_json()["message"]["id"]
+        missed = ws.receive_json()["message"]["id"]
+
+    with client.websocket_connect(_url(subject, last_message_id=last_seen)) as ws:
+        frame = ws.receive_json()
+    assert frame["type"] == "history"
+    assert [m["id"] for m in frame["messages"]] == [missed]
+
+
+def test_resume_from_unknown_message_fails_explicitly(client, subject):
+    with client.websocket_connect(_url(subject, last_message_id="missing")) as ws:
+        frame = ws.receive_json()
+        ws.send_json({"type": "ping"})
+        assert ws.receive_json() == {"type": "pong"}
+    assert frame["type"] == "resume_failed"
+    assert frame["last_message_id"] == "missing"
+
+
+def test_unknown_subject_is_closed(client):
+    with client.websocket_connect("/api/ws/chat/missing") as ws:
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_json()
+    assert closed.value.code == 4404
+
+
+def test_heartbeat_timeout_closes_once(client, subject, monkeypatch):
+    monkeypatch.setattr(chat_session, "HEARTBEAT_INTERVAL", 0.01)
+    monkeypatch.setattr(chat_session, "HEARTBEAT_TIMEOUT", 0)
+    with client.websocket_connect(_url(subject)) as ws:
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_json()
+    assert closed.value.code == 1001
+
+
+def test_resume_past_the_limit_fails_instead_of_truncating(client, subject, monkeypatch):
+    with client.websocket_connect(_url(subject)) as ws:
+        ws.send_json({"type": "message", "content": "First question", "client_id": "c1"})
+        last_seen = ws.receive_json()["message"]["id"]
+        ws.receive_json()
+        ws.send_json({"type": "message", "content": "Second question", "client_id": "c2"})
+        ws.receive_json()
+        ws.receive_json()
+
+    monkeypatch.setattr(chat_session, "RESUME_LIMIT", 2)
+    with client.websocket_connect(_url(subject, last_message_id=last_seen)) as ws:
+        frame = ws.receive_json()
+    assert frame["type"] == "resume_failed"
+    assert frame["last_message_id"] == last_seen
+
+
+def test_binary_frame_gets_an_error_and_connection_stays_open(client, subject):
+    with client.websocket_connect(_url(subject)) as ws:
+        ws.send_bytes(b"\x00\x01")
+        assert ws.receive_json()["type"] == "error"
+        ws.send_json({"type": "ping"})
+        assert ws.receive_json() == {"type": "pong"}
+
+
+def test_failed_turn_is_reported_and_connection_stays_open(client, subject, monkeypatch):
+    def failing_reply(self, content, ai_service):
+        raise RuntimeError("provider down")
+
+    monkeypatch.setattr(chat_session.ChatSession, "reply", failing_reply)
+    with client.websocket_connect(_url(subject)) as ws:
+        ws.send_json({"type": "message", "content": "Hello?", "client_id": "c1"})
+        assert ws.receive_json()["message"]["sender"] == "user"
+        error = ws.receive_json()
+        ws.send_json({"type": "ping"})
+        assert ws.receive_json() == {"type": "pong"}
+    assert error["type"] == "error"
+    assert error["client_id"] == "c1"
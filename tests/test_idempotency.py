@@ -0,0 +1,136 @@
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+import pytest
+from fastapi import HTTPException, Response
+import idempotency
+import models
+from database import SessionLocal
+
+
+def _key():
+    return str(uuid.uuid4())
+
+
+def test_without_key_handler_always_runs(migrated):
+    calls = []
+    for _ in range(2):
+        idempotency.run_idempotent(None, "test", {}, Response(), lambda: calls.append(1) or {"n": len(calls)})
+    assert len(calls) == 2
+
+
+def test_duplicate_replays_stored_response(migrated):
+    key, calls = _key(), []
+    handler = lambda: calls.append(1) or {"n": len(calls)}
+    first = idempotency.run_idempotent(key, "test", {"a": 1}, Response(), handler, status_code=201)
+    replayed = Response()
+    second = idempotency.run_idempotent(key, "test", {"a": 1}, replayed, handler, status_code=201)
+    assert first == second == {"n": 1}
+    assert calls == [1]
+    assert replayed.headers["Idempotent-Replayed"] == "true"
+    assert replayed.status_code == 201
+
+
+def test_key_reused_with_different_payload_is_rejected(migrated):
+    key = _key()
+    idempotency.run_idempotent(key, "test", {"a": 1}, Response(), lambda: {})
+    with pytest.raises(HTTPException) as excinfo:
+        idempotency.run_idempotent(key, "test", {"a": 2}, Response(), lambda: {})
+    assert excinfo.value.status_code == 422
+
+
+def test_failed_request_releases_key(migrated):
+    key = _key()
+
+    def failing():
+        raise HTTPException(status_code=404)
+
+    with pytest.raises(HTTPException):
+        idempotency.run_idempotent(key, "test", {}, Response(), failing)
+    assert idempotency.run_idempotent(key, "test", {}, Response(), lambda: {"ok": True}) == {"ok": True}
+
+
+def test_concurrent_duplicate_waits_for_first(migrated):
+    key, calls, results = _key(), [], []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.3)
+        return {"n": len(calls)}
+
+    threads = [
+        threading.Thread(target=lambda: results.append(idempotency.run_idempotent(key, "test", {}, Response(), slow)))
+        for _ in range(3)
+    ]
+    for t in threads:
+        t.start()
+        time.sleep(0.02)
+    for t in threads:
+        t.join(timeout=10)
+    assert calls == [1]
+    assert results == [{"n": 1}] * 3
+
+
+def test_waiting_duplicates_are_capped(migrated, monkeypatch):
+    key, calls = _key(), []
+    claimed_at, _ = idempotency._claim("test", key, idempotency._request_hash({}))
+    monkeypatch.setattr(idempotency, "MAX_WAITING", 0)
+    with pytest.raises(HTTPException) as excinfo:
+        idempotency.run_idempotent(key, "test", {}, Response(), lambda: calls.append(1))
+    assert excinfo.value.status_code == 409
+    assert excinfo.value.headers["Retry-After"] == str(idempotency.RETRY_AFTER_SECONDS)
+    assert calls == []
+    assert idempotency._waiting == 0
+    idempotency._release("test", key, claimed_at)
+
+
+def _insert_abandoned(key):
+    db = SessionLocal()
+    long_ago = datetime.now() - idempotency.LOCK_TIMEOUT - timedelta(seconds=1)
+    db.add(models.IdempotencyKey(
+        scope="test", key=key, request_hash=idempotency._request_hash({}),
+        status=idempotency.IN_PROGRESS, created_at=long_ago, expires_at=long_ago
+    ))
+    db.commit()
+    db.close()
+
+
+def test_abandoned_key_is_taken_over_by_exactly_one_request(migrated):
+    key = _key()
+    _insert_abandoned(key)
+    claims = []
+    barrier = threading.Barrier(4)
+
+    def claim():
+        barrier.wait()
+        claims.append(idempotency._claim("test", key, idempotency._request_hash({}))[0])
+
+    threads = [threading.Thread(target=claim) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+    assert len([c for c in claims if c is not None]) == 1
+
+
+def test_purge_removes_only_expired_keys(migrated):
+    stale, fresh = _key(), _key()
+    _insert_abandoned(stale)
+    idempotency.run_idempotent(fresh, "test", {}, Response(), lambda: {})
+    idempotency.purge_expired()
+    db = SessionLocal()
+    keys = {k for (k,) in db.query(models.IdempotencyKey.key).filter(models.IdempotencyKey.key.in_([stale, fresh]))}
+    db.close()
+    assert keys == {fresh}
+
+
+def test_chat_retry_with_key_does_not_save_duplicates(db, subject, client):
+    body = {"subject_id": subject.id, "message": "what is a mole?"}
+    headers = {"Idempotency-Key": _key()}
+    first = client.post("/api/chat", json=body, headers=headers)
+    second = client.post("/api/chat", json=body, headers=headers)
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert db.query(models.ChatMessage).filter(models.ChatMessage.subject_id == subject.id).count() == 2
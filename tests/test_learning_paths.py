@@ -0,0 +1,154 @@
+import uuid
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import Column, DateTime, MetaData, String, Table, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+import crud
+import learning_paths
+import models
+from database import SessionLocal
+from migrate import _default_sql
+
+
+def _structure(title):
+    return {
+        "subject": "Mathematics",
+        "level": "beginner",
+        "totalEstimatedTime": "2 weeks",
+        "modules": [{
+            "id": 1,
+            "title": title,
+            "description": "Limits and continuity",
+            "objectives": ["Compute limits"],
+            "estimatedTime": "1 week",
+            "resources": [],
+            "prerequisites": []
+        }]
+    }
+
+
+def _generate(title):
+    def generate(subject_name, level, priority=None, allow_fallback=True):
+        return _structure(title)
+    return generate
+
+
+@pytest.fixture
+def stale_path(db, subject):
+    learning_path = learning_paths.commit_new_version(db, subject.id, "beginner", _structure("Old"))
+    learning_path.generated_at = datetime.now() - learning_paths.MAX_AGE - timedelta(days=1)
+    db.commit()
+    return learning_path
+
+
+def _url(subject):
+    return f"/api/subjects/{subject.id}/learning-plan/beginner"
+
+
+def test_stale_path_is_served_then_swapped(client, subject, stale_path, monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(learning_paths, "regenerate", lambda *args: scheduled.append(args))
+
+    response = client.get(_url(subject))
+    assert response.json()["modules"][0]["title"] == "Old"
+    assert response.headers["X-Learning-Path-Stale"] == "true"
+    assert response.headers["X-Learning-Path-Version"] == "1"
+    assert [args[0] for args in scheduled] == [stale_path.id]
+
+    monkeypatch.undo()
+    learning_paths.regenerate(stale_path.id, _generate("New"))
+    response = client.get(_url(subject))
+    assert response.json()["modules"][0]["title"] == "New"
+    assert response.headers["X-Learning-Path-Version"] == "2"
+    assert "X-Learning-Path-Stale" not in response.headers
+
+
+def test_user_with_progress_stays_on_their_version(client, db, subject, stale_path):
+    db.add(models.UserProgress(
+        id=str(uuid.uuid4()),
+        user_id="student-1",
+        learning_path_id=stale_path.id,
+        progress_data={"completed": [1]}
+    ))
+    db.commit()
+    learning_paths.regenerate(stale_path.id, _generate("New"))
+
+    pinned = client.get(_url(subject), params={"user_id": "student-1"})
+    assert pinned.headers["X-Learning-Path-Id"] == stale_path.id
+    assert pinned.json()["modules"][0]["title"] == "Old"
+    # Their old version is no longer current, so it is not refreshed again
+    assert "X-Learning-Path-Stale" not in pinned.headers
+    assert client.get(_url(subject)).headers["X-Learning-Path-Version"] == "2"
+
+
+def test_invalid_regeneration_keeps_current_version(db, subject, stale_path):
+    learning_paths.regenerate(stale_path.id, lambda *args, **kwargs: {"modules": []})
+    db.expire_all()
+    assert learning_paths.get_current(db, subject.id, "beginner").id == stale_path.id
+
+
+def test_refresh_not_scheduled_within_retry_interval(client, db, subject, stale_path, monkeypatch):
+    stale_path.refresh_started_at = datetime.now()
+    db.commit()
+    scheduled = []
+    monkeypatch.setattr(learning_paths, "regenerate", lambda *args: scheduled.append(args))
+
+    response = client.get(_url(subject))
+    assert response.headers["X-Learning-Path-Version"] == "1"
+    assert "X-Learning-Path-Stale" not in response.headers
+    assert scheduled == []
+
+    stale_path.refresh_started_at = datetime.now() - learning_paths.RETRY_INTERVAL - timedelta(minutes=1)
+    db.commit()
+    client.get(_url(subject))
+    assert len(scheduled) == 1
+
+
+def test_concurrent_versions_cannot_share_a_number(db, subject, stale_path):
+    other = SessionLocal()
+    try:
+        # Both writers read version 1 as current before either commits
+        learning_paths.add_version(other, subject.id, "beginner", _structure("Theirs"))
+        learning_paths.add_version(db, subject.id, "beginner", _structure("Ours"))
+        other.commit()
+        with pytest.raises(IntegrityError):
+            db.commit()
+        db.rollback()
+
+        learning_path = learning_paths.commit_new_version(db, subject.id, "beginner", _structure("Ours"))
+        assert learning_path.version == 3
+        currents = db.query(models.LearningPath).filter(
+            models.LearningPath.subject_id == subject.id,
+            models.LearningPath.is_current == True
+        ).all()
+        assert [p.id for p in currents] == [learning_path.id]
+    finally:
+        other.close()
+
+
+def test_added_column_defaults_are_rendered_for_the_dialect():
+    table = Table(
+        "example", MetaData(),
+        Column("label", String, server_default="it's"),
+        Column("seen_at", DateTime, server_default=func.now())
+    )
+    assert _default_sql(table.c.label, sqlite.dialect()) == "'it''s'"
+    assert _default_sql(table.c.seen_at, postgresql.dialect()) == "now()"
+    with pytest.raises(ValueError):
+        _default_sql(table.c.seen_at, sqlite.dialect())
+
+
+def test_first_generation_is_scheduled_for_the_requesting_user(client, subject, monkeypatch):
+    calls = []
+
+    class FakeService:
+        def generate_learning_path(self, subject_name, level, **kwargs):
+            calls.append(kwargs)
+            return _structure("First")
+
+    monkeypatch.setattr(crud, "get_ai_service", lambda: FakeService())
+    response = client.get(_url(subject), params={"user_id": "student-2"})
+    assert response.json()["modules"][0]["title"] == "First"
+    # Each user gets their own round-robin turn in the LLM scheduler
+    assert calls == [{"user_id": "student-2"}]
@@ -0,0 +1,63 @@
+import threading
+import time
+import pytest
+from llm_scheduler import LLMScheduler, SchedulerFull, INTERACTIVE, BULK, BACKGROUND
+
+
+def _run_all(scheduler, jobs, hold=0.02):
+    """Occupy the only slot, queue jobs in order, then release and record run order"""
+    order = []
+    gate = threading.Event()
+    blocker = threading.Thread(target=scheduler.run, args=(INTERACTIVE, "blocker", gate.wait))
+    blocker.start()
+    time.sleep(0.05)
+    threads = []
+    for priority, user_id, tag in jobs:
+        t = threading.Thread(target=scheduler.run, args=(priority, user_id, lambda tag=tag: (order.append(tag), time.sleep(hold))))
+        t.start()
+        threads.append(t)
+        time.sleep(0.01)
+    gate.set()
+    for t in [blocker] + threads:
+        t.join(timeout=5)
+    return order
+
+
+def test_interactive_runs_before_queued_bulk_and_background():
+    scheduler = LLMScheduler(max_concurrency=1, quotas={BULK: 1, BACKGROUND: 1})
+    order = _run_all(scheduler, [
+        (BACKGROUND, "a", "bg"),
+        (BULK, "a", "bulk"),
+        (INTERACTIVE, "b", "chat"),
+    ])
+    assert order == ["chat", "bulk", "bg"]
+
+
+def test_users_are_served_round_robin_within_a_class():
+    scheduler = LLMScheduler(max_concurrency=1, quotas={BULK: 1})
+    order = _run_all(scheduler, [
+        (BULK, "alice", "a1"),
+        (BULK, "alice", "a2"),
+        (BULK, "alice", "a3"),
+        (BULK, "bob", "b1"),
+    ])
+    assert order == ["a1", "b1", "a2", "a3"]
+
+
+def test_waiting_bulk_calls_are_capped():
+    scheduler = LLMScheduler(max_concurrency=1, quotas={BULK: 1}, max_waiting={BULK: 1})
+    gate = threading.Event()
+    running = threading.Thread(target=scheduler.run, args=(BULK, "a", gate.wait))
+    running.start()
+    time.sleep(0.05)
+    waiting = threading.Thread(target=scheduler.run, args=(BULK, "a", lambda: None))
+    waiting.start()
+    time.sleep(0.05)
+    with pytest.raises(SchedulerFull):
+        scheduler.run(BULK, "b", lambda: None)
+    gate.set()
+    running.join(timeout=5)
+    waiting.join(timeout=5)
+    stats = scheduler.stats()["classes"][BULK]
+    assert stats["rejected"] == 1
+    assert stats["completed"] == 2
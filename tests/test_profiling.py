@@ -0,0 +1,51 @@
+import pytest
+import profiling
+
+TOKEN = "test-admin-token"
+
+
+@pytest.fixture
+def client(client, monkeypatch):
+    # The shared client, with admin routes enabled and profiling reset after
+    monkeypatch.setenv("ADMIN_TOKEN", TOKEN)
+    yield client
+    profiling.config.save(False, 0.01, None, True)
+
+
+def _admin(client, method, url, **kwargs):
+    return client.request(method, url, headers={"X-Admin-Token": TOKEN}, **kwargs)
+
+
+def test_admin_routes_require_token(client, monkeypatch):
+    assert client.get("/api/admin/profiling").status_code == 401
+    assert client.get("/api/admin/profiling", headers={"X-Admin-Token": "wrong"}).status_code == 401
+    assert _admin(client, "GET", "/api/admin/llm-scheduler").status_code == 200
+    monkeypatch.delenv("ADMIN_TOKEN")
+    assert _admin(client, "GET", "/api/admin/profiling").status_code == 403
+
+
+def test_settings_are_shared_with_other_workers(client):
+    response = _admin(client, "PUT", "/api/admin/profiling", json={"enabled": True, "sample_rate": 0.5, "route": None, "cprofile": False})
+    assert response.status_code == 200
+    other_worker = profiling.ProfilerConfig()
+    other_worker.load()
+    assert other_worker.enabled is True
+    assert other_worker.sample_rate == 0.5
+
+
+def test_profiled_request_is_stored_and_downloadable(client):
+    _admin(client, "PUT", "/api/admin/profiling", json={"enabled": True, "sample_rate": 0.0, "route": "/api/health", "cprofile": True})
+    assert client.get("/api/health").status_code == 200
+    profiles = _admin(client, "GET", "/api/admin/profiles").json()
+    health = [p for p in profiles if p["route"] == "/api/health"]
+    assert health and health[0]["pid"] > 0
+    assert {"endpoint", "serialization", "framework"} <= set(health[0]["phases_ms"])
+    # Serialization is timed around FastAPI's own call, not derived
+    assert health[0]["phase_counts"]["serialization"] == 1
+
+    profile_id = health[0]["id"]
+    detail = _admin(client, "GET", f"/api/admin/profiles/{profile_id}").json()
+    assert "health_check" in detail["top_functions"]
+    download = _admin(client, "GET", f"/api/admin/profiles/{profile_id}/pstats")
+    assert download.status_code == 200
+    assert download.headers["content-type"] == "application/octet-stream"
@@ -0,0 +1,108 @@
+import uuid
+from datetime import datetime
+from sqlalchemy import text
+import models
+import search
+
+
+def _chat(db, subject, content):
+    message = models.ChatMessage(
+        id=str(uuid.uuid4()),
+        subject_id=subject.id,
+        sender="user",
+        content=content,
+        timestamp=datetime.now()
+    )
+    db.add(message)
+    db.commit()
+    return message
+
+
+def _path(db, subject, title):
+    learning_path = models.LearningPath(
+        id=str(uuid.uuid4()),
+        subject_id=subject.id,
+        level="beginner",
+        structure={"modules": [{"id": 1, "title": title, "description": "Limits and continuity", "objectives": ["Compute limits"]}]},
+        is_current=True
+    )
+    db.add(learning_path)
+    db.commit()
+    return learning_path
+
+
+def _ids(result):
+    return {r["id"] for r in result["results"]}
+
+
+def test_chat_message_is_indexed_on_insert(db, subject):
+    message = _chat(db, subject, "hello derivatives")
+    result = search.search(db, "derivatives", subject_id=subject.id)
+    assert _ids(result) == {message.id}
+    assert "<b>derivatives</b>" in result["results"][0]["snippet"]
+
+
+def test_partial_last_term_matches_as_prefix(db, subject):
+    message = _chat(db, subject, "learning integration by parts")
+    for partial in ["learni", "integrati", "learning integ"]:
+        assert _ids(search.search(db, partial, subject_id=subject.id)) == {message.id}, partial
+
+
+def test_complete_terms_match_stems(db, subject):
+    message = _chat(db, subject, "chain rule for derivatives")
+    assert _ids(search.search(db, "derivative rule", subject_id=subject.id)) == {message.id}
+
+
+def test_terms_without_word_characters_are_ignored(db, subject):
+    message = _chat(db, subject, "what is a limit of pointers")
+    for query in ["pointers ?", "what is a limit ?", "pointer !!"]:
+        assert _ids(search.search(db, query, subject_id=subject.id)) == {message.id}, query
+    assert search.search(db, "?", subject_id=subject.id)["total"] == 0
+
+
+def test_filter_columns_do_not_match_query_terms(db, subject):
+    _chat(db, subject, "nothing relevant here")
+    assert search.search(db, "chat", subject_id=subject.id)["total"] == 0
+    assert search.search(db, subject.id.split("-")[0], subject_id=subject.id)["total"] == 0
+
+
+def test_learning_path_reindexed_on_update_and_removed_on_delete(db, subject):
+    learning_path = _path(db, subject, "Introduction to Calculus")
+    assert _ids(search.search(db, "calculus", subject_id=subject.id, kind="module")) == {learning_path.id}
+
+    learning_path.structure = {"modules": [{"id": 1, "title": "Vector Algebra", "description": "", "objectives": []}]}
+    db.commit()
+    assert search.search(db, "calculus", subject_id=subject.id)["total"] == 0
+    assert _ids(search.search(db, "vector", subject_id=subject.id)) == {learning_path.id}
+
+    db.delete(learning_path)
+    db.commit()
+    assert search.search(db, "vector", subject_id=subject.id)["total"] == 0
+    refs = db.execute(text("SELECT COUNT(*) FROM search_index_refs WHERE ref_id = :id"), {"id": learning_path.id}).scalar()
+    assert refs == 0
+
+
+def test_superseded_version_leaves_the_index(db, subject):
+    learning_path = _path(db, subject, "Topology Basics")
+    learning_path.is_current = False
+    db.commit()
+    assert search.search(db, "topology", subject_id=subject.id)["total"] == 0
+
+
+def test_filters_and_pagination(db, subject):
+    other = models.Subject(id=str(uuid.uuid4()), name="Physics")
+    db.add(other)
+    db.commit()
+    for i in range(3):
+        _chat(db, subject, f"momentum question {i}")
+    _chat(db, other, "momentum question elsewhere")
+    page = search.search(db, "momentum", subject_id=subject.id, limit=2, offset=0)
+    assert page["total"] == 3
+    assert len(page["results"]) == 2
+    rest = search.search(db, "momentum", subject_id=subject.id, limit=2, offset=2)
+    assert len(rest["results"]) == 1
+    assert not _ids(page) & _ids(rest)
+
+
+def test_fts_syntax_in_user_input_is_treated_as_text(db, subject):
+    assert search.search(db, 'AND OR NEAR( "', subject_id=subject.id)["total"] == 0